@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Kuldeep S Meel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Scaling benchmark of weighted_to_unweighted.py on seeded synthetic
+# instances. Every case runs in a fresh process, so that its peak memory is
+# its own. tests/benchmark_baseline.json is the baseline of the quick
+# preset, checked in, to compare to:
+#   ./tests/benchmark.py --preset quick --compare tests/benchmark_baseline.json
+# and to update, with the python, numpy and machine it was made on, after a
+# change that is meant to change the timings:
+#   ./tests/benchmark.py --preset quick --repeat 3 --save tests/benchmark_baseline.json
+
+import time
+import argparse
+import contextlib
+import decimal
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from weighted_to_unweighted import Converter, peak_rss_mb
+
+BASELINE_VERSION = 2
+
+# clauses written per chunk by the generator
+GEN_CHUNK = 1000000
+
+# Each parameter is swept on its own, with the others at "base". The largest
+# case of "large" has 10^8 literals.
+PRESETS = {
+    "quick": {
+        "base": {"vars": 10**4, "clauses": 10**5, "weighted": 0.1, "prec": 7},
+        "vars": [10**3, 10**4, 10**5],
+        "clauses": [10**4, 10**5, 10**6],
+        "weighted": [0.01, 0.1, 1.0],
+        "prec": [4, 7, 20, 40],
+    },
+    "large": {
+        "base": {"vars": 10**6, "clauses": 10**7, "weighted": 0.1, "prec": 7},
+        "vars": [10**4, 10**5, 10**6, 10**7],
+        "clauses": [10**5, 10**6, 10**7, 10**8//3],
+        "weighted": [0.01, 0.1, 0.5, 1.0],
+        "prec": [4, 7, 20, 40, 60],
+    },
+}
+
+# as timed by Converter.phase(), scan_* are part of parse
+PHASES = ["parse", "scan_clauses", "scan_lines", "weights", "normalize", "quantize", "encode", "write"]
+
+
+# Writes a random weighted CNF with clauses of width literals. A weighted
+# fraction of the variables gets a "c p weight" line. The same parameters
+# and seed always give the same file (given the same numpy, if it is used).
+def generate_cnf(fname, num_vars, num_clauses, weighted, seed, width=3):
+    if width < 2:
+        print("ERROR: the clauses must have at least 2 literals, unit clauses are rejected by the converter")
+        exit(-1)
+
+    fmt = ' '.join(['%d'] * width) + ' 0\n'
+    rng = random.Random(seed)
+    nprng = np.random.default_rng(seed) if np is not None else None
+    with open(fname, 'w') as f:
+        f.write("p cnf %d %d\n" % (num_vars, num_clauses))
+        done = 0
+        while done < num_clauses:
+            n = min(GEN_CHUNK, num_clauses-done)
+            if nprng is not None:
+                lits = nprng.integers(1, num_vars+1, size=n*width)
+                lits[nprng.random(n*width) < 0.5] *= -1
+                lits = lits.tolist()
+            else:
+                lits = [rng.choice((-1, 1))*rng.randint(1, num_vars) for _ in range(n*width)]
+            f.write((fmt*n) % tuple(lits))
+            done += n
+
+        num_weighted = int(round(num_vars*weighted))
+        for var in sorted(rng.sample(range(1, num_vars+1), num_weighted)):
+            # weights that round to 0 or 1 are rejected, even at --prec 4
+            w = rng.randint(5*10**5, 95*10**5)
+            f.write("c p weight %d 0.%07d 0\n" % (var, w))
+
+
+def case_name(params):
+    return "v%d_c%d_w%g_p%d" % (params["vars"], params["clauses"], params["weighted"], params["prec"])
+
+
+def make_cases(preset, grid):
+    p = PRESETS[preset]
+    keys = ["vars", "clauses", "weighted", "prec"]
+    cases = []
+    if grid:
+        combos = [{}]
+        for key in keys:
+            combos = [dict(c, **{key: val}) for c in combos for val in p[key]]
+        cases = combos
+    else:
+        for key in keys:
+            for val in p[key]:
+                params = dict(p["base"], **{key: val})
+                if params not in cases:
+                    cases.append(params)
+    return cases
+
+
+def instance_file(workdir, params, seed):
+    return os.path.join(workdir, "v%d_c%d_w%g_s%d.cnf" % (
+        params["vars"], params["clauses"], params["weighted"], seed))
+
+
+# Runs in its own process: converts fname with Converter.transform(). The
+# output of the converter is kept out of the benchmark's own.
+def run_case(job):
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            return timed_transform(*job)
+    except SystemExit:
+        errors = [l for l in out.getvalue().splitlines() if l.startswith("ERROR: ")]
+        return {"error": " ".join(errors) if errors else "conversion failed"}
+
+
+def timed_transform(fname, outfname, prec):
+    decimal.getcontext().prec = 100
+    startTime = time.time()
+    c = Converter(precision=prec)
+    with open(fname, 'rb') as f:
+        ret = c.transform(f, outfname)
+    total = time.time()-startTime
+
+    return {"phases": {ph: c.phase_times.get(ph, 0.0) for ph in PHASES}, "total": total,
+            "peak_rss_mb": peak_rss_mb(),
+            "input_mb": os.path.getsize(fname)/(1024*1024),
+            "output_mb": os.path.getsize(outfname)/(1024*1024),
+            "added_vars": ret.vars-ret.origVars, "clauses": ret.totalCount, "div": ret.div}
+
+
+def run_benchmark(cases, workdir, seed, repeat):
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for params in cases:
+        fname = instance_file(workdir, params, seed)
+        if not os.path.exists(fname):
+            t = time.time()
+            generate_cnf(fname+".tmp", params["vars"], params["clauses"], params["weighted"], seed)
+            os.replace(fname+".tmp", fname)
+            print("Generated %s in %0.1f s" % (fname, time.time()-t))
+
+        outfname = os.path.join(workdir, "out.cnf")
+        runs = []
+        for _ in range(repeat):
+            with ctx.Pool(1) as pool:
+                runs.append(pool.apply(run_case, ((fname, outfname, params["prec"]),)))
+            if "error" in runs[-1]:
+                print("ERROR: %s failed to convert: %s" % (case_name(params), runs[-1]["error"]))
+                exit(-1)
+        os.unlink(outfname)
+
+        # the fastest of the repeats, phase by phase
+        res = runs[0]
+        res["phases"] = {ph: min(r["phases"][ph] for r in runs) for ph in PHASES}
+        res["total"] = min(r["total"] for r in runs)
+        if res["peak_rss_mb"] is not None:
+            res["peak_rss_mb"] = max(r["peak_rss_mb"] for r in runs)
+        res["params"] = params
+        results[case_name(params)] = res
+        print_case(case_name(params), res)
+    return results
+
+
+def print_case(name, res):
+    phases = " ".join("%s: %7.3f" % (ph, res["phases"][ph]) for ph in PHASES if not ph.startswith("scan_"))
+    mem = "%8.1f MB" % res["peak_rss_mb"] if res["peak_rss_mb"] is not None else "n/a"
+    print("%-28s %s total: %7.3f s  peak: %s" % (name, phases, res["total"], mem))
+
+
+# Compares to a saved baseline. Returns the number of regressions, i.e.
+# phases (or peak memory) that got slower (larger) by more than tolerance.
+# Differences of less than min_time seconds are noise, not regressions.
+def compare(results, baseline, tolerance, min_time):
+    regressions = 0
+    for name, res in results.items():
+        if name not in baseline["cases"]:
+            print("%-28s not in the baseline" % name)
+            continue
+        old = baseline["cases"][name]
+        pairs = [(ph, old["phases"][ph], res["phases"][ph]) for ph in PHASES]
+        pairs.append(("total", old["total"], res["total"]))
+        if old.get("peak_rss_mb") is not None and res["peak_rss_mb"] is not None:
+            pairs.append(("peak_rss_mb", old["peak_rss_mb"], res["peak_rss_mb"]))
+
+        ratios = []
+        for what, before, now in pairs:
+            if what != "peak_rss_mb" and max(before, now) < min_time:
+                continue
+            ratio = now/before if before > 0 else float("inf")
+            ratios.append("%s: %0.2fx" % (what, ratio))
+            if ratio > 1+tolerance and (what == "peak_rss_mb" or now-before > min_time):
+                print("REGRESSION: %s %s %0.3f -> %0.3f" % (name, what, before, now))
+                regressions += 1
+        print("%-28s %s" % (name, " ".join(ratios)))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preset", help="Set of cases to run. Default: quick",
+                        choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--grid", help="Run every combination of the parameters, not just one sweep per parameter",
+                        action="store_const", const=True)
+    parser.add_argument("--seed", help="Random number generator seed", type=int, default=1)
+    parser.add_argument("--repeat", help="Runs per case, the fastest counts. Default: 1", type=int, default=1)
+    parser.add_argument("--workdir", help="Where the generated instances are kept, so that they can be reused. Default: a temporary directory")
+    parser.add_argument("--save", help="Write the results as a JSON baseline to this file")
+    parser.add_argument("--compare", help="Compare the results to this JSON baseline")
+    parser.add_argument("--tolerance", help="Slowdown that counts as a regression in --compare. Default: 0.25",
+                        type=float, default=0.25)
+    parser.add_argument("--min-time", help="Phases faster than this are not compared, and a smaller slowdown is not a regression. Default: 0.05 s",
+                        type=float, default=0.05, dest="min_time")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get("version") != BASELINE_VERSION:
+            print("ERROR: %s is not a version %d baseline" % (args.compare, BASELINE_VERSION))
+            exit(-1)
+
+    cases = make_cases(args.preset, args.grid)
+    if args.workdir is not None:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_benchmark(cases, args.workdir, args.seed, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as d:
+            results = run_benchmark(cases, d, args.seed, args.repeat)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({"version": BASELINE_VERSION, "preset": args.preset, "seed": args.seed,
+                       "python": platform.python_version(),
+                       "numpy": np.__version__ if np is not None else None,
+                       "machine": platform.machine(), "cases": results}, f, indent=1, sort_keys=True)
+        print("Baseline written to %s" % args.save)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance, args.min_time)
+        print("%d regressions" % regressions)
+        exit(0 if regressions == 0 else -1)
+    exit(0)
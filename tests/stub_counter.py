@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Kuldeep S Meel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# A stand-in for ApproxMC or Ganak in the tests of --count: counts the
+# models of a small CNF, projected on its "c p show" variables, by brute
+# force and prints them like a counter would. Reads the CNF from the file
+# given, or from stdin. With --no-read it exits without reading anything.
+
+import itertools
+import sys
+
+
+def read_cnf(f):
+    num_vars = 0
+    show = []
+    clauses = []
+    for line in f:
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == "p":
+            num_vars = int(parts[2])
+        elif parts[:3] == ["c", "p", "show"]:
+            show += [int(v) for v in parts[3:-1]]
+        elif parts[0] != "c":
+            clauses.append([int(l) for l in parts[:-1]])
+    return num_vars, show, clauses
+
+
+def count(num_vars, show, clauses):
+    models = set()
+    for vals in itertools.product([False, True], repeat=num_vars):
+        if all(any(vals[abs(l)-1] == (l > 0) for l in cl) for cl in clauses):
+            models.add(tuple(vals[v-1] for v in show))
+    return len(models)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if "--no-read" in args:
+        print("c not reading anything")
+        exit(1)
+
+    if args:
+        with open(args[0], 'r') as f:
+            num_vars, show, clauses = read_cnf(f)
+    else:
+        num_vars, show, clauses = read_cnf(sys.stdin)
+
+    n = count(num_vars, show, clauses)
+    print("c [stub] brute force over %d vars" % num_vars)
+    print("s SATISFIABLE" if n > 0 else "s UNSATISFIABLE")
+    print("s mc %d" % n)
+    exit(10 if n > 0 else 20)
@@ -22,81 +22,80 @@
 # THE SOFTWARE.
 
 import unittest
+import itertools
+import contextlib
 import random
 import math
 import decimal
-from weighted_to_unweighted import Converter
+import gzip
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import fractions
+from weighted_to_unweighted import Converter, PreparedCNF, ShowSet, run_batch, chain_clauses, compact_clauses, open_cnf
+from benchmark import generate_cnf
+try:
+    import verify
+except ImportError:
+    verify = None
+import weighted_to_unweighted
 
 verbose = False
 
-
+# the example from the README
+README_CNF = """p cnf 2 1
+c t wpmc
+c p show 1 2 0
+1 2 0
+c p weight 1 0.9 0
+c p weight 2 0.5 0
+"""
+
+README_OUT = """p cnf 9 9 
+c p show 1 2 3 4 5 6 7 8 9 0
+1 2 0
+9 8 5 4 3 -1 0
+7 5 4 3 -1 0
+6 5 4 3 -1 0
+9 -7 -6 1 0
+-8 -7 -6 1 0
+-5 1 0
+-4 1 0
+-3 1 0
+c MUST MULTIPLY BY 1 0
+"""
+
+
+# The chain formula of weight w at precision prec, and the error of the
+# weight it encodes, which is the fraction of its models with var true.
+# Weights that quantize to 0 or 1 need no chain, var is fixed instead.
 def get_transl_err(prec, w):
     c = Converter(precision=prec)
     w = decimal.Decimal(w)
 
     # 2 out of 2**3 (i.e. 0.125)
-    iWeight, kWeight = c.parseWeight(w)
-    print("iweight: %3d kweight: %3d prec: %3d w: %s" % (iWeight, kWeight, prec, w))
+    bit_mult, bit_prec = c.quantize_weight(w)
+    print("bit_mult: %3d bit_prec: %3d prec: %3d w: %s" % (bit_mult, bit_prec, prec, w))
     var = 1
     origvars = 20
-    cls = 20
-    eLines, vars, cls = c.encodeCNF(var, iWeight, kWeight, origvars, 0)
+    if bit_prec == 0:
+        eLines, vars = "%d 0\n" % (var if bit_mult == 1 else -var), origvars
+    else:
+        eLines, vars, cls, div = c.encodeCNF(var, bit_mult, bit_prec, origvars, 0, 0)
     newvars = vars-origvars
     if verbose:
         print("%s" % eLines)
         print("new vars: ", newvars)
-        print("cls: ", cls)
-
-    ok = {}
-    ba = {}
-    ok[True] = 0
-    ok[False] = 0
-    ba[True] = 0
-    ba[False] = 0
-    ok_tot = 0
-    ba_tot = 0
-    for x in range(2**(newvars+1)):
-        setting = {}
-        for i in range(1, newvars+1):
-            setting[origvars+(newvars+1-i)] = bool((x >> i) & 1)
-        setting[var] = bool((x >> 0) & 1)
-        #print(setting)
-
-        overall_val = True
-        for line in eLines.split("\n"):
-            val = False
-            if line == "":
-                continue
-
-            #print("line.split:", line.split())
-            for lit in line.split(" "):
-                lit = int(lit)
-                if lit == 0:
-                    continue
-
-                if lit > 0:
-                    if setting[lit]:
-                        val = True
-
-                if lit < 0:
-                    if not setting[-lit]:
-                        val = True
-
-            #print("val:", val)
-            if not val:
-                overall_val = False
-                break
-
-        #print("overall val:", overall_val)
-        if overall_val:
-            ok[setting[var]] += 1
-            ok_tot += 1
-        else:
-            ba[setting[var]] += 1
-            ba_tot += 1
-
-    print("->OK[true]: %d/%d OK[false] = %d/%d" % (ok[True], ok_tot, ok[False], ok_tot))
-    actual_val = decimal.Decimal(ok[True])/decimal.Decimal(ok_tot)
+
+    clauses = [[int(lit) for lit in line.split()[:-1]] for line in eLines.splitlines()]
+    ba, ok = verify.projected_counts(clauses, [var] + list(range(origvars+1, vars+1)), [var])
+    print("->OK[true]: %d/%d OK[false] = %d/%d" % (ok, ok+ba, ba, ok+ba))
+    actual_val = decimal.Decimal(ok)/decimal.Decimal(ok+ba)
 
     print("->Diff: %s vs %s" % (w, actual_val))
     error = (w-actual_val).copy_abs()
@@ -105,57 +104,604 @@ def get_transl_err(prec, w):
 
 
 class TestMyMethods(unittest.TestCase):
-    def test_parseWeight(self):
+    def test_quantize_weight(self):
         c = Converter(precision=7)
         c.verbose = False
-        # returns kWeight/iWeight combo
+        D = decimal.Decimal
+        # returns bit_mult/bit_prec combo
 
         # trivial cases
-        self.assertEqual(c.parseWeight(1.0), (1, 0))
-        self.assertEqual(c.parseWeight(0.0), (0, 0))
+        self.assertEqual(c.quantize_weight(D("1.0")), (1, 0))
+        self.assertEqual(c.quantize_weight(D("0.0")), (0, 0))
 
         # 1 of 4 is 0.25
-        self.assertEqual(c.parseWeight(0.25), (1, 2))
+        self.assertEqual(c.quantize_weight(D("0.25")), (1, 2))
 
         # 1 of 8 is 0.125
-        self.assertEqual(c.parseWeight(0.125), (1, 3))
+        self.assertEqual(c.quantize_weight(D("0.125")), (1, 3))
 
         # 3 of 4 is 0.75
-        self.assertEqual(c.parseWeight(0.75), (3, 2))
+        self.assertEqual(c.quantize_weight(D("0.75")), (3, 2))
 
         # close to 0.5 should give me 1,1
-        self.assertEqual(c.parseWeight(0.5), (1, 1))
-        self.assertEqual(c.parseWeight(0.49888), (1, 1))
-        self.assertEqual(c.parseWeight(0.4987), (1, 1))
-        self.assertEqual(c.parseWeight(0.5003), (1, 1))
+        self.assertEqual(c.quantize_weight(D("0.5")), (1, 1))
+        self.assertEqual(c.quantize_weight(D("0.49888")), (1, 1))
+        self.assertEqual(c.quantize_weight(D("0.4987")), (1, 1))
+        self.assertEqual(c.quantize_weight(D("0.5003")), (1, 1))
 
         # for small precision, we are in a mess
         c.precision = 3
-        self.assertEqual(c.parseWeight(0.0001), (0, 0))
-        self.assertEqual(c.parseWeight(0.9999), (1, 0))
+        self.assertEqual(c.quantize_weight(D("0.0001")), (0, 0))
+        self.assertEqual(c.quantize_weight(D("0.9999")), (1, 0))
 
         # for larger precision, we are good
         c.precision = 13
-        self.assertNotEqual(c.parseWeight(0.0001), (0, 0))
-        self.assertNotEqual(c.parseWeight(0.9999), (1, 0))
+        self.assertNotEqual(c.quantize_weight(D("0.0001")), (0, 0))
+        self.assertNotEqual(c.quantize_weight(D("0.9999")), (1, 0))
 
         # for small precision, we should get 1,0 / 0,0 here
         c.precision = 4
-        self.assertEqual(c.parseWeight(0.9977877), (1, 0))
-        self.assertEqual(c.parseWeight(0.0022123), (0, 0))
+        self.assertEqual(c.quantize_weight(D("0.9977877")), (1, 0))
+        self.assertEqual(c.quantize_weight(D("0.0022123")), (0, 0))
 
         # 3 of 4 is 0.75 -- just about enough bits here
         c = Converter(precision=2)
-        self.assertEqual(c.parseWeight(0.75), (3, 2))
+        self.assertEqual(c.quantize_weight(D("0.75")), (3, 2))
 
         # precision must be at least 2 bits
         with self.assertRaises(AssertionError):
             c = Converter(precision=1)
-            c.parseWeight(0.75)
+            c.quantize_weight(D("0.75"))
 
+    def test_transform_streaming(self):
+        c = Converter(precision=7)
+        with tempfile.TemporaryDirectory() as d:
+            out = os.path.join(d, "out.cnf")
+            # a generator can only be read once
+            ret = c.transform((l for l in README_CNF.splitlines()), out)
+            with open(out) as f:
+                self.assertEqual(f.read(), README_OUT)
+        self.assertEqual((ret.origVars, ret.vars, ret.totalCount, ret.div), (2, 9, 9, 8))
+
+    def test_stats(self):
+        c = Converter(precision=7)
+        with tempfile.TemporaryDirectory() as d:
+            out = os.path.join(d, "out.cnf.gz")
+            ret = c.transform(io.BytesIO(README_CNF.encode()), out)
+        stats = c.get_stats(ret)
+        for phase in ["parse", "scan_clauses", "scan_lines", "weights", "normalize", "quantize", "encode", "write"]:
+            self.assertIn(phase, stats["phases"])
+        self.assertEqual(stats["counters"], {"lines": 6, "clauses": 1, "weightedLits": 2, "distinctWeights": 2,
+                                             "showVars": 2, "foldedVars": 0, "bytesWritten": len(README_OUT)})
+        self.assertEqual((stats["addedVars"], stats["div"]), (7, 8))
+
+    def test_compressed(self):
+        with tempfile.TemporaryDirectory() as d:
+            for ext in (".gz", ".xz", ".bz2"):
+                inp = os.path.join(d, "in.cnf" + ext)
+                out = os.path.join(d, "out.cnf" + ext)
+                with open_cnf(inp, "wb") as f:
+                    f.write(README_CNF.encode())
+                with open_cnf(inp, "rb") as f:
+                    Converter(precision=7).transform(f, out)
+                with open_cnf(out, "rb") as f:
+                    self.assertEqual(f.read().decode(), README_OUT)
+            with gzip.open(os.path.join(d, "out.cnf.gz"), "rt") as f:
+                self.assertEqual(f.read(), README_OUT)
+
+    def test_in_place(self):
+        with tempfile.TemporaryDirectory() as d:
+            inp = os.path.join(d, "in.cnf")
+            with open(inp, "w") as f:
+                f.write(README_CNF)
+            with contextlib.redirect_stdout(io.StringIO()):
+                Converter(precision=7).transform_file(inp, inp)
+            with open(inp) as f:
+                self.assertEqual(f.read(), README_OUT)
+
+    def test_chain_cache(self):
+        c = Converter(precision=7)
+        first, vars, cls, div = c.encodeCNF(1, 115, 7, 2, 1, 0)
+        second, vars, cls, div = c.encodeCNF(2, 115, 7, vars, cls, div)
+        self.assertEqual((c.cache_hits, c.cache_misses), (1, 1))
+        self.assertEqual((vars, cls, div), (16, 17, 14))
+        self.assertEqual(first.split("\n")[0], "9 8 5 4 3 -1 0")
+        self.assertEqual(second.split("\n")[0], "16 15 12 11 10 -2 0")
+
+    def test_convert(self):
+        r = Converter(precision=7).convert(io.BytesIO(README_CNF.encode()))
+        expected = [list(map(int, l.split()[:-1])) for l in README_OUT.splitlines() if l[0] not in "cp"]
+        self.assertEqual(list(r.clauses()), expected)
+        self.assertEqual(list(r.show), list(range(1, 10)))
+        self.assertEqual((r.vars, r.totalCount, r.div, r.multiplier), (9, 9, 8, 1))
+
+    def test_count(self):
+        stub = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_counter.py")
+        with contextlib.redirect_stdout(io.StringIO()):
+            r = Converter(precision=7).count(io.BytesIO(README_CNF.encode()), [sys.executable, stub])
+            # with the exact count of the README's CNF, 243 and not ApproxMC's 244
+            self.assertEqual((r.count, r.div, r.multiplier), (243, 8, 1))
+            self.assertEqual(r.weighted, fractions.Fraction(243, 256))
+            self.assertEqual(weighted_to_unweighted.exact_decimal(r.weighted), "0.94921875")
+
+            r = Converter(precision=7).count(io.BytesIO(README_CNF.encode()), [sys.executable, stub, "{}"])
+            self.assertEqual(r.count, 243)
+            with self.assertRaises(SystemExit):
+                Converter(precision=7).count(io.BytesIO(README_CNF.encode()), [sys.executable, stub, "--no-read"])
+
+    def test_fold_free_vars(self):
+        # var 3 is in no clause, var 4 only in a comment
+        cnf = README_CNF.replace("p cnf 2 1", "p cnf 4 1").replace("c p show 1 2 0", "c p show 1 2 3 4 0")
+        cnf += "c 4 -4 0\nc p weight 3 0.3 0\nc p weight -4 0.8 0\n"
+        stub = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_counter.py")
+        with contextlib.redirect_stdout(io.StringIO()):
+            c = Converter(precision=7)
+            r = c.count(io.BytesIO(cnf.encode()), [sys.executable, stub])
+        self.assertEqual(c.counters["foldedVars"], 2)
+        # no chains for them, only a factor of 2 each
+        self.assertEqual((r.vars, r.div), (11, 10))
+        self.assertEqual(r.weighted, fractions.Fraction(243, 256))
+
+    def test_split(self):
+        import stub_counter
+        with tempfile.TemporaryDirectory() as d:
+            inp = os.path.join(d, "in.cnf")
+            with open(inp, "w") as f:
+                f.write(README_CNF)
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                ret = Converter(precision=7).split_file(inp, os.path.join(d, "out.cnf.gz"), 4)
+            # one chain, its last variable first, then any show variable
+            self.assertIn("WARNING: Only 1 chains", out.getvalue())
+            with open(os.path.join(d, "out.manifest.json")) as f:
+                manifest = json.load(f)
+            self.assertEqual(manifest["splitVars"], [9, 1])
+            self.assertEqual((ret.totalCount, ret.div, manifest["div"]), (11, 8, 8))
+
+            counts = []
+            for shard in manifest["shards"]:
+                with gzip.open(os.path.join(d, shard["file"]), "rt") as f:
+                    counts.append(stub_counter.count(*stub_counter.read_cnf(f)))
+                self.assertLessEqual(shard["fraction"][0], counts[-1]/243)
+                self.assertLessEqual(counts[-1]/243, shard["fraction"][1])
+            self.assertEqual(sum(counts), 243)
+            self.assertEqual(weighted_to_unweighted.combine_counts(manifest, counts), fractions.Fraction(243, 256))
+
+    def test_plan(self):
+        with tempfile.TemporaryDirectory() as d:
+            inp = os.path.join(d, "in.cnf")
+            out = os.path.join(d, "out.cnf")
+            # the chain variables go from 2 to 3 digits
+            generate_cnf(inp, 95, 300, 0.2, 3)
+            for encoding in ("chain", "compact"):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ret = Converter(precision=20, encoding=encoding).transform_file(inp, out)
+                    plan = Converter(precision=20, encoding=encoding).plan_file(inp)
+                with open(out) as f:
+                    text = f.read()
+                clauses = [l for l in text.splitlines() if l[0].isdigit() or l[0] == '-']
+                self.assertEqual((plan["vars"], plan["clauses"], plan["div"]), (ret.vars, ret.totalCount, ret.div))
+                self.assertEqual(plan["literals"], sum(len(cl.split())-1 for cl in clauses))
+                self.assertEqual(plan["bytes"], len(text))
+
+            summary = os.path.join(d, "plan.tsv")
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(weighted_to_unweighted.run_plan([inp], {"precision": 20, "encoding": "compact"}, 1, summary), 0)
+            with open(summary) as f:
+                rows = [l.rstrip("\n").split("\t") for l in f]
+            row = dict(zip(rows[0], rows[1]))
+            self.assertEqual((row["status"], row["bytes"]), ("ok", str(plan["bytes"])))
+
+    @unittest.skipIf(weighted_to_unweighted.sqlite3 is None, "needs sqlite3")
+    def test_delta(self):
+        # var 5 is in no clause, var 1 has both weights declared
+        cnf = ("p cnf 6 4\nc p show 1 2 3 4 5 6 0\n1 2 0\n-2 3 4 0\n-6 2 0\n4 -2 0\n"
+               "c p weight 1 0.3 0\nc p weight -1 0.9 0\nc p weight 2 0.6 0\nc p weight 5 0.25 0\n")
+        changed = cnf.replace("weight 1 0.3", "weight 1 0.55").replace("weight 5 0.25", "weight 5 0.75")
+        with tempfile.TemporaryDirectory() as d:
+            inp = os.path.join(d, "in.cnf")
+            out = os.path.join(d, "out.cnf")
+            changed_inp = os.path.join(d, "changed.cnf")
+            fresh = os.path.join(d, "fresh.cnf")
+            for fname, text in ((inp, cnf), (changed_inp, changed)):
+                with open(fname, "w") as f:
+                    f.write(text)
+            with contextlib.redirect_stdout(io.StringIO()):
+                Converter(precision=7, indexed=True).transform_file(inp, out)
+                Converter(precision=7, indexed=True).transform_file(changed_inp, fresh)
+                res = Converter(precision=7).apply_delta(out, ["c p weight 1 0.55 0", "c p weight 5 0.75 0"])
+            self.assertEqual((res["changed"], res["folded"], res["relocated"]), (1, 1, 0))
+            # the same as converting the changed CNF
+            with open(out) as f, open(fresh) as g:
+                self.assertEqual(f.read(), g.read())
+
+            # a chain that does not fit its block moves to the end
+            with contextlib.redirect_stdout(io.StringIO()):
+                res = Converter(precision=7).apply_delta(out, ["c p weight 1 0.1796875 0", "c p weight -1 0.8203125 0"])
+            self.assertEqual(res["relocated"], 1)
+            with open(out) as f:
+                lines = f.read().splitlines()
+            chain = weighted_to_unweighted.ChainTemplate(23, 7).format(1, 6).splitlines()
+            self.assertEqual(lines[-len(chain)-1:-1], chain)
+            self.assertEqual(int(lines[0].split()[3]), sum(1 for l in lines if l[0].isdigit() or l[0] == '-'))
+
+    def test_generate_cnf(self):
+        with tempfile.TemporaryDirectory() as d:
+            a = os.path.join(d, "a.cnf")
+            b = os.path.join(d, "b.cnf")
+            generate_cnf(a, 50, 200, 0.2, 5)
+            generate_cnf(b, 50, 200, 0.2, 5)
+            with open(a) as f, open(b) as g:
+                text = f.read()
+                self.assertEqual(text, g.read())
+            self.assertEqual(text.count("c p weight"), 10)
+
+            ret = Converter(precision=4).transform(text.splitlines(), os.path.join(d, "out.cnf"))
+            self.assertEqual((ret.origVars, ret.origCls), (50, 200))
+
+    def test_prepared_cnf(self):
+        with tempfile.TemporaryDirectory() as d, PreparedCNF(io.BytesIO(README_CNF.encode())) as p:
+            out = os.path.join(d, "out.cnf")
+            for _ in range(2):
+                ret = p.transform(out, precision=7)
+                with open(out) as f:
+                    self.assertEqual(f.read(), README_OUT)
+                self.assertEqual((ret.vars, ret.div), (9, 8))
+
+            # the same as a CNF with just these weights
+            r = p.convert({1: "0.75"}, precision=7)
+            text = README_CNF.replace("c p weight 1 0.9 0\nc p weight 2 0.5 0\n", "c p weight 1 0.75 0\n")
+            expected = Converter(precision=7).convert(text.splitlines())
+            self.assertEqual(list(r.clauses()), list(expected.clauses()))
+            self.assertEqual((list(r.show), r.div, r.multiplier), ([1, 2, 3, 4], 2, 1))
+
+    def test_prepared_convert_time(self):
+        weights = {var: "0.3" for var in range(1, 11)}
+        times = []
+        with tempfile.TemporaryDirectory() as d:
+            for num_clauses in (100, 300000):
+                inp = os.path.join(d, "in%d.cnf" % num_clauses)
+                generate_cnf(inp, 100, num_clauses, 0.0, 1)
+                with open(inp, "rb") as f, contextlib.redirect_stdout(io.StringIO()), PreparedCNF(f) as p:
+                    r = p.convert(weights, precision=10)
+                    # the clauses of the CNF are shared, not copied
+                    self.assertIs(r.base_lits, p.lits)
+                    self.assertEqual(len(r.offsets)-1, r.num_clauses()-num_clauses)
+                    best = None
+                    for _ in range(10):
+                        start = time.perf_counter()
+                        p.convert(weights, precision=10)
+                        took = time.perf_counter()-start
+                        best = took if best is None else min(best, took)
+                    times.append(best)
+        # copying the 300000 clauses takes several times as long as the conversion
+        self.assertLess(times[1], 2*times[0] + 0.0005)
+
+    def test_prepared_in_place(self):
+        with tempfile.TemporaryDirectory() as d:
+            inp = os.path.join(d, "in.cnf")
+            with open(inp, "w") as f:
+                f.write(README_CNF)
+            with open(inp, "rb") as f, PreparedCNF(f) as p:
+                weights = {1: "0.9", 2: "0.5"}
+                p.transform(inp, weights, precision=7)
+                # the CNF still reads its clauses, not a closed or reused fd
+                out = os.path.join(d, "out.cnf")
+                p.transform(out, weights, precision=7)
+                for fname in (inp, out):
+                    with open(fname) as f:
+                        self.assertEqual(f.read(), README_OUT)
+
+    def test_parse_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            inp = os.path.join(d, "in.cnf")
+            out = os.path.join(d, "out.cnf")
+            cache = os.path.join(d, "cache")
+            with open(inp, "w") as f:
+                f.write(README_CNF + "c a comment\n1 -2 0\n")
+            expected = README_OUT.replace("1 2 0\n", "1 2 0\nc a comment\n1 -2 0\n")
+            for hit in (0, 1):
+                c = Converter(precision=7, parse_cache=cache)
+                ret = c.transform_file(inp, out)
+                self.assertEqual(c.counters["parseCacheHit"], hit)
+                with open(out) as f:
+                    self.assertEqual(f.read(), expected)
+                self.assertEqual((ret.origCls, ret.totalCount, ret.div), (1, 9, 8))
+
+            r = Converter(precision=7, parse_cache=cache).convert_file(inp)
+            self.assertEqual(list(r.clauses())[:2], [[1, 2], [1, -2]])
+            self.assertEqual(list(r.show), list(range(1, 10)))
+
+            # same size, other weight: the cache is not used
+            with open(inp, "w") as f:
+                f.write(README_CNF.replace("0.9", "0.7") + "c a comment\n1 -2 0\n")
+            c = Converter(precision=7, parse_cache=cache)
+            c.transform_file(inp, out)
+            self.assertEqual(c.counters["parseCacheHit"], 0)
+            self.assertEqual(len(os.listdir(cache)), 2)
+
+    def test_result_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            inp = os.path.join(d, "in.cnf")
+            out = os.path.join(d, "out.cnf")
+            cache = os.path.join(d, "cache")
+            with open(inp, "w") as f:
+                f.write(README_CNF)
+            for prec, hit in ((7, 0), (7, 1), (8, 0)):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    c = Converter(precision=prec, result_cache=cache, result_cache_link=True)
+                    ret = c.transform_file(inp, out)
+                self.assertEqual(c.counters["resultCacheHit"], hit)
+                self.assertEqual(c.get_stats(ret)["counters"]["showVars"], 2)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    plain = Converter(precision=prec).transform_file(inp, out + ".plain")
+                self.assertEqual((ret.origVars, ret.vars, ret.totalCount, ret.div),
+                                 (plain.origVars, plain.vars, plain.totalCount, plain.div))
+                with open(out) as f, open(out + ".plain") as g:
+                    self.assertEqual(f.read(), g.read())
+            self.assertEqual(os.stat(out).st_nlink, 2)
+            # the cache does not take the output's write permission
+            self.assertTrue(os.stat(out).st_mode & 0o200)
+            self.assertEqual(weighted_to_unweighted.read_cache_stats(cache), {"hits": 1, "misses": 2, "evictions": 0})
+
+            # writing the output again leaves the linked cache entry alone
+            with contextlib.redirect_stdout(io.StringIO()):
+                Converter(precision=7).transform_file(inp, out)
+                c = Converter(precision=7, result_cache=cache, result_cache_size=0)
+                c.transform_file(inp, out)
+            self.assertEqual(c.counters["resultCacheHit"], 1)
+            with open(out) as f:
+                self.assertEqual(f.read(), README_OUT)
+
+            # a cache of size 0 keeps only the entry just added
+            with contextlib.redirect_stdout(io.StringIO()):
+                Converter(precision=9, result_cache=cache, result_cache_size=0).transform_file(inp, out)
+            self.assertEqual(len([n for n in os.listdir(cache) if n.endswith(".out")]), 1)
+            self.assertEqual(weighted_to_unweighted.read_cache_stats(cache)["evictions"], 2)
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "good.cnf"), "w") as f:
+                f.write(README_CNF)
+            with open(os.path.join(d, "bad.cnf"), "w") as f:
+                f.write("p cnf 2 1\n1 0\n")
+            outdir = os.path.join(d, "out")
+            summary = os.path.join(d, "summary.tsv")
+            self.assertEqual(run_batch([d], outdir, {"precision": 7}, 2, summary), -1)
+
+            with open(os.path.join(outdir, "good.cnf")) as f:
+                self.assertEqual(f.read(), README_OUT)
+            with open(summary) as f:
+                rows = [l.rstrip("\n").split("\t") for l in f]
+            self.assertEqual(rows[0][:5], ["file", "status", "origVars", "addedVars", "div"])
+            self.assertEqual(rows[1][1], "error")
+            self.assertIn("only one literal", rows[1][6])
+            self.assertEqual(rows[2][1:5], ["ok", "2", "7", "8"])
+
+    def test_serve(self):
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import weighted_to_unweighted_client as client
+        with tempfile.TemporaryDirectory() as d:
+            inp = os.path.join(d, "in.cnf")
+            with open(inp, "w") as f:
+                f.write(README_CNF)
+            sock = os.path.join(d, "w2u.sock")
+            with contextlib.redirect_stdout(io.StringIO()):
+                server = threading.Thread(target=weighted_to_unweighted.serve, args=(sock, 2, 4))
+                server.start()
+                while not os.path.exists(sock):
+                    server.join(0.05)
+                mode = os.stat(sock).st_mode
+
+                out = os.path.join(d, "out.cnf")
+                res = client.convert(sock, inp, out, {"precision": 7})
+                with open(out) as f:
+                    self.assertEqual(f.read(), README_OUT)
+                self.assertEqual([res[k] for k in ["status", "origVars", "origCls", "vars", "totalCount", "div"]],
+                                 ["ok", 2, 1, 9, 9, 8])
+                res = client.convert(sock, inp, out, {"precision": 7, "encoding": "none"})
+                self.assertEqual(res["status"], "error")
+                for options in ({"precision": True}, {"result_cache_size": False}, {"error_bound": True}):
+                    res = client.convert(sock, inp, out, options)
+                    self.assertIn("bad option", res["error"])
+
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                    s.connect(sock)
+                    s.sendall(b'{"stop": true}\n')
+                    self.assertEqual(json.loads(s.makefile('rb').readline()), {"status": "stopped"})
+                server.join()
+            self.assertFalse(os.path.exists(sock))
+            self.assertEqual(mode & 0o077, 0)
+
+    def test_parse_stream(self):
+        text = "p cnf 5 4\nc p show 1 2 3 0\n1 -2 0\n3  4 0\nc kept\n-5 1 0\n 2 3 0\nw 1 0.5"
+        by_line = Converter(precision=7).parse(text.splitlines())
+        in_bulk = Converter(precision=7).parse(io.BytesIO(text.encode()))
+        for cnf in (by_line, in_bulk):
+            self.assertEqual((cnf.maxvar, cnf.num_clauses), (5, 4))
+            self.assertEqual(cnf.weights, {1: decimal.Decimal("0.5")})
+            self.assertEqual(cnf.read_body(), b"1 -2 0\n3 4 0\nc kept\n-5 1 0\n2 3 0\n")
+            cnf.close()
+
+        with self.assertRaises(SystemExit):
+            Converter(precision=7).parse(io.BytesIO(b"p cnf 2 2\n1 2 0\n-2 0\n"))
+
+    def test_passthrough(self):
+        text = "p cnf 5 4\nc p show 1 2 3 0\n1 -2 0\n3 4 0\nc kept\n-5 1 0\n2  3 0\nw 1 0.75\n2 5 0"
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, "in.cnf")
+            with open(fname, "w") as f:
+                f.write(text)
+            with open(fname, "rb") as f:
+                cnf = Converter(precision=7).parse(f)
+            # the first clauses are taken from the file, the normalized ones
+            # and the last one without a newline are not
+            self.assertEqual(cnf.segments[0][1:], (text.index("1 -2"), len("1 -2 0\n3 4 0\n")))
+            self.assertNotEqual(cnf.segments[0][0], None)
+            self.assertEqual(cnf.read_body(), b"1 -2 0\n3 4 0\nc kept\n-5 1 0\n2 3 0\n2 5 0\n")
+            cnf.close()
+
+            out = os.path.join(d, "out.cnf")
+            with open(fname, "rb") as f:
+                Converter(precision=7).transform(f, out)
+            Converter(precision=7).transform(text.splitlines(), out + ".ref")
+            with open(out) as f, open(out + ".ref") as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_parse_jobs(self):
+        lines = ["p cnf 40 60", "c p show 1 2 3 0"]
+        for i in range(60):
+            lines.append("%d -%d %d 0" % (i % 40 + 1, (i*7) % 40 + 1, (i*13) % 40 + 1))
+            if i % 10 == 0:
+                lines.append("c p weight %d 0.%d 0" % (i // 10 + 1, i + 11))
+                lines.append("c p show %d 0" % (i // 2 + 4))
+        text = "\n".join(lines) + "\n"
+        bad = text.replace("c p weight 4 0.41 0", "c p weight 2 0.41 0")
+
+        # tiny blocks, so that it is split into many chunks
+        saved = (weighted_to_unweighted.BLOCK_SIZE, weighted_to_unweighted.PARALLEL_MIN_SIZE)
+        weighted_to_unweighted.BLOCK_SIZE = 64
+        weighted_to_unweighted.PARALLEL_MIN_SIZE = 64
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                fname = os.path.join(d, "in.cnf")
+                with open(fname, "w") as f:
+                    f.write(text)
+                out = os.path.join(d, "out.cnf")
+                with open(fname, "rb") as f:
+                    Converter(precision=7, parse_jobs=3).transform(f, out)
+                Converter(precision=7).transform(text.splitlines(), out + ".ref")
+                with open(out) as f, open(out + ".ref") as g:
+                    self.assertEqual(f.read(), g.read())
+
+                # a weight declared twice, in two different chunks
+                with open(fname, "w") as f:
+                    f.write(bad)
+                msg = io.StringIO()
+                with open(fname, "rb") as f, contextlib.redirect_stdout(msg), self.assertRaises(SystemExit):
+                    Converter(precision=7, parse_jobs=3).transform(f, out)
+                line = bad.splitlines().index("c p weight 2 0.41 0") + 1
+                self.assertIn("Lit 2 has TWO weights declared", msg.getvalue())
+                self.assertIn("on line %d of the CNF" % line, msg.getvalue())
+        finally:
+            weighted_to_unweighted.BLOCK_SIZE, weighted_to_unweighted.PARALLEL_MIN_SIZE = saved
+
+    def test_show_set(self):
+        big = list(range(30000, 10000, -2))
+        for vars in ([7, 3, 3, 9, 1], big + big[::3]):
+            show = ShowSet()
+            show.update(vars)
+            show.add(vars[0])
+            show.add(12)
+            show.add_range(40001, 40003)
+            show.add_range(40004, 40010)
+            expected = list(dict.fromkeys(vars + [12])) + list(range(40001, 40011))
+            self.assertEqual(list(show), expected)
+            self.assertEqual(len(show), len(expected))
+            self.assertEqual(b"".join(show.format()).decode(), "".join("%d " % v for v in expected))
+            self.assertIn(40005, show)
+            self.assertNotIn(2, show)
+        self.assertEqual(show.ranges, [(40001, 40010)])
+
+        show = ShowSet()
+        show.update([5, 6, 7, 2, 3])
+        show.add_range(8, 20)
+        self.assertEqual(show.to_ranges(), [(5, 7), (2, 3), (8, 20)])
+
+    def test_chain_clauses(self):
+        c = Converter(precision=7)
+        rnd = random.Random(3)
+        cases = [(1, 2), (3, 2), (1, 5), (31, 5), (115, 7)]
+        cases += [(rnd.randrange(1, 2**p, 2), p) for p in (10, 40, 64) for _ in range(20)]
+        for bit_mult, bit_prec in cases:
+            # what encodeCNF used to build with getCNF()
+            binStr = bin(bit_mult)[2:-1].zfill(bit_prec-1)
+            complementStr = "".join("1" if b == "0" else "0" for b in binStr)
+            expected = c.getCNF(-5, binStr, True, 10) + c.getCNF(5, complementStr, False, 10)
+            self.assertEqual(list(chain_clauses(5, bit_mult, bit_prec, 10)), expected)
+
+            lines, vars, cls, div = c.encodeCNF(5, bit_mult, bit_prec, 10, 0, 0)
+            self.assertEqual(lines, "".join(" ".join(map(str, cl)) + " 0\n" for cl in expected))
+            self.assertEqual((vars, cls, div), (10+bit_prec, len(expected), bit_prec))
+
+    def test_compact_clauses(self):
+        for bit_prec in range(1, 7):
+            for bit_mult in range(1, 2**bit_prec, 2):
+                # var 1, chain vars 2.., aux vars after them
+                cls = list(compact_clauses(1, bit_mult, bit_prec, 1, bit_prec+2))
+                num_vars = max(abs(l) for cl in cls for l in cl+[bit_prec+1])
+                counts = {}
+                for vals in itertools.product([False, True], repeat=num_vars):
+                    if all(any(vals[abs(l)-1] == (l > 0) for l in cl) for cl in cls):
+                        key = vals[:bit_prec+1]
+                        counts[key] = counts.get(key, 0)+1
+                # every auxiliary variable is defined exactly
+                self.assertEqual(set(counts.values()), {1})
+                self.assertEqual(sum(1 for key in counts if key[0]), bit_mult)
+                self.assertEqual(sum(1 for key in counts if not key[0]), 2**bit_prec-bit_mult)
+
+        # short chains stay chain formulas, long ones get smaller
+        c = Converter(precision=7, encoding="compact")
+        with tempfile.TemporaryDirectory() as d:
+            out = os.path.join(d, "out.cnf")
+            c.transform(io.BytesIO(README_CNF.encode()), out)
+            with open(out) as f:
+                self.assertEqual(f.read(), README_OUT)
+        self.assertEqual((c.counters["weightLits"], c.counters["chainFormulaLits"]), (30, 30))
+        r = Converter(precision=40, encoding="compact").convert(io.BytesIO(README_CNF.encode()))
+        self.assertEqual(list(r.show), list(range(1, 2+r.div)))  # weight 0.5 adds no variable
+        self.assertGreater(r.vars, max(r.show))
+
+    def test_quantize_weights(self):
+        c = Converter(precision=7)
+        D = decimal.Decimal
+        weights = [D("0.9"), D("0.25"), D("0.5"), D("0.4987"), D("1"), D("0"), D("0.9")]
+        expected = [(115, 7), (1, 2), (1, 1), (1, 1), (1, 0), (0, 0), (115, 7)]
+        self.assertEqual([c.quantize_weight(w) for w in weights], expected)
+        self.assertEqual(c.quantize_weights(weights), expected)
+
+        # exact far beyond the 53 bits of a float
+        c.precision = 64
+        w = D(2**63+1)/D(2**64)
+        self.assertEqual(c.quantize_weight(w), (2**63+1, 64))
+        w = D(2**61+2**40)/D(2**64)
+        self.assertEqual(c.quantize_weights([w]), [(2**21+1, 24)])
+
+    def test_adaptive_precisions(self):
+        D = decimal.Decimal
+        weights = [D("0.9"), D("0.3"), D("0.3"), D("0.123"), D("0.5"), D("0.75")]
+        for bound in (0.1, 0.01, 1e-6):
+            c = Converter(precision=16, error_bound=bound)
+            bits = c.adaptive_precisions(weights)
+            quantized = c.quantize_weights(weights, bits)
+            self.assertLessEqual(c.quantization_error(weights, quantized), bound)
+            # exact weights need no more bits than they have
+            self.assertEqual(quantized[4:], [(1, 1), (3, 2)])
+            # equal weights get the same number of bits
+            self.assertEqual(bits[1], bits[2])
+
+        # uniform 16 bits are more than needed for 1%
+        c = Converter(precision=16, error_bound=0.01)
+        adaptive = c.quantize_weights(weights, c.adaptive_precisions(weights))
+        uniform = c.quantize_weights(weights)
+        self.assertLess(sum(p for _, p in adaptive), sum(p for _, p in uniform))
+
+    @unittest.skipIf(verify is None, "the verifier needs numpy")
     def test_encodeCNF(self):
         self.assertEqual(get_transl_err(10, 0.0), 0)
         self.assertEqual(get_transl_err(10, 1.0), 0)
+        self.assertEqual(get_transl_err(10, 0.375), 0)
+        self.assertLessEqual(get_transl_err(16, decimal.Decimal("0.3")), decimal.Decimal(2)**-17)
+
+    @unittest.skipIf(verify is None, "the verifier needs numpy")
+    def test_verify(self):
+        res = verify.verify(README_CNF, precision=7)
+        self.assertEqual((res["count"], res["div"], res["exact"]), (243, 8, fractions.Fraction(19, 20)))
+        self.assertTrue(res["ok"])
+
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(verify.fuzz(300, 1, [10, 12, 14, 16], ["chain", "compact"])[0], 0)
+            self.assertEqual(verify.fuzz(100, 2, [10], ["chain", "compact"], error_bound=0.001)[0], 0)
+        self.assertEqual(out.getvalue(), "")
 
 
 if __name__ == '__main__':
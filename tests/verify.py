@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016 Kuldeep S Meel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Brute-force verifier of weighted_to_unweighted.py on small random CNFs.
+# Both the weighted input and the converted output are evaluated over all
+# assignments at once, 64 assignments per bit-packed NumPy word, and the
+# exact weighted count is compared to count/2**div*multiplier. Example:
+#   ./tests/verify.py --instances 2000 --prec 10 12 16
+
+import argparse
+import contextlib
+import decimal
+import fractions
+import io
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from weighted_to_unweighted import Converter, ENCODINGS
+
+# the most variables a formula may have, the bitmaps are 2**MAX_VARS/8 bytes
+MAX_VARS = 28
+
+# the most variables of a converted CNF in fuzz(), which then takes about a
+# millisecond per instance
+FUZZ_VARS = 20
+
+# bit k of PATTERNS[i] is bit i of k: the values of the variable at position
+# i < 6 in each of the 64 assignments of a word
+PATTERNS = [np.uint64(sum(1 << k for k in range(64) if (k >> i) & 1)) for i in range(6)]
+ALL = np.uint64(2**64-1)
+
+# bit k of FIRST_OF_BLOCK[h] is set if k is a multiple of 2**h
+FIRST_OF_BLOCK = [np.uint64(sum(1 << k for k in range(0, 64, 1 << h))) for h in range(6)]
+
+# the number of bits set in each byte
+POPCOUNT = np.array([bin(b).count("1") for b in range(256)], dtype=np.uint8)
+
+# w(var)+w(-var) of the weights that are given for both literals, picked
+# so that the converter normalises them exactly
+TOTALS = [fractions.Fraction(t) for t in ("1", "2", "4", "1/2", "4/5", "5/4")]
+
+
+# The parts of a weighted CNF that matter for its count. show is None if
+# there is no "c p show" line, weights maps literals to Fractions.
+def read_cnf(lines):
+    cnf = {"vars": 0, "show": None, "clauses": [], "weights": {}, "multiplier": fractions.Fraction(1)}
+    for line in lines:
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == "p":
+            cnf["vars"] = int(parts[2])
+        elif parts[:3] == ["c", "p", "show"]:
+            cnf["show"] = (cnf["show"] or []) + [int(v) for v in parts[3:-1]]
+        elif parts[:3] == ["c", "p", "weight"]:
+            cnf["weights"][int(parts[3])] = fractions.Fraction(parts[4])
+        elif parts[:4] == ["c", "MUST", "MULTIPLY", "BY"]:
+            cnf["multiplier"] = fractions.Fraction(parts[4])
+        elif parts[0] != "c":
+            cnf["clauses"].append([int(l) for l in parts[:-1]])
+    return cnf
+
+
+# The number of assignments of show that extend to a model of clauses, for
+# each assignment of weighted, a subset of show: entry i is the count with
+# weighted[j] true iff bit j of i is set. Variables are laid out with the
+# hidden ones, i.e. those in clauses but not in show, in the lowest bits of
+# the assignment number, then the rest of show, then weighted, so that the
+# projection is an OR over consecutive bits and the grouping by weighted a
+# reshape.
+def projected_counts(clauses, show, weighted=(), max_vars=MAX_VARS):
+    show = list(dict.fromkeys(show))
+    weighted = list(weighted)
+    free = [v for v in show if v not in set(weighted)]
+    hidden = sorted(set(abs(l) for cl in clauses for l in cl)-set(show))
+    # a formula of less than 6 variables still fills a word
+    pad = max(0, 6-len(hidden)-len(show))
+    order = [None]*pad + hidden + free + weighted
+    if len(order) > max_vars:
+        raise ValueError("%d variables, at most %d can be enumerated" % (len(order), max_vars))
+    pos = {v: i for i, v in enumerate(order) if v is not None}
+
+    sat = np.full(1 << (len(order)-6), ALL, dtype=np.uint64)
+    acc = np.empty_like(sat)
+    for cl in clauses:
+        acc[:] = 0
+        for lit in cl:
+            i = pos[abs(lit)]
+            if i < 6:
+                acc |= PATTERNS[i] if lit > 0 else ~PATTERNS[i]
+            else:
+                # the words where the variable has the value that satisfies lit
+                acc.reshape(-1, 2, 1 << (i-6))[:, 1 if lit > 0 else 0, :] = ALL
+        sat &= acc
+
+    h = pad+len(hidden)
+    if h >= 6:
+        projected = sat.reshape(-1, 1 << (h-6)).any(axis=1)
+        return [int(n) for n in projected.reshape(1 << len(weighted), -1).sum(axis=1)]
+
+    # OR the 2**h assignments of each show assignment into the first one
+    for j in range(h):
+        sat |= sat >> np.uint64(1 << j)
+    sat &= FIRST_OF_BLOCK[h]
+    data = sat.astype('<u8', copy=False).view(np.uint8)
+    if len(order)-len(weighted) >= 3:
+        per_byte = POPCOUNT[data]
+    else:
+        per_byte = np.unpackbits(data, bitorder='little')
+    return [int(n) for n in per_byte.reshape(1 << len(weighted), -1).sum(axis=1, dtype=np.int64)]
+
+
+# (weighted vars, their (w(var), w(-var))) as the converter sees them: a
+# weight outside the sampling set is ignored, a missing literal's weight is
+# 1 minus the other's
+def literal_weights(cnf):
+    show = cnf["show"] if cnf["show"] is not None else range(1, cnf["vars"]+1)
+    weights = {}
+    for var in sorted(set(abs(lit) for lit in cnf["weights"]) & set(show)):
+        pos = cnf["weights"].get(var)
+        neg = cnf["weights"].get(-var)
+        weights[var] = (pos if pos is not None else 1-neg, neg if neg is not None else 1-pos)
+    return list(show), weights
+
+
+def weighted_sum(cnf, weights):
+    show, _ = literal_weights(cnf)
+    wvars = sorted(weights)
+    counts = projected_counts(cnf["clauses"], show, wvars)
+    total = fractions.Fraction(0)
+    for i, n in enumerate(counts):
+        if n == 0:
+            continue
+        term = fractions.Fraction(n)
+        for j, var in enumerate(wvars):
+            term *= weights[var][0] if (i >> j) & 1 else weights[var][1]
+        total += term
+    return total*cnf["multiplier"]
+
+
+# the exact weighted count of cnf, projected on its sampling set
+def weighted_count(cnf):
+    return weighted_sum(cnf, literal_weights(cnf)[1])
+
+
+# (count, error) with every normalised weight p rounded to q, a multiple of
+# 2**-prec, as --prec does it. error bounds the relative error of the count
+# due to the rounding, with |p-q|/min(p, 1-p) per weight.
+def quantized_count(cnf, prec):
+    weights = {}
+    bound = fractions.Fraction(1)
+    for var, (pos, neg) in literal_weights(cnf)[1].items():
+        total = pos+neg
+        p = pos/total
+        q = fractions.Fraction(round(p*2**prec), 2**prec)
+        weights[var] = (q*total, (1-q)*total)
+        bound *= 1+abs(p-q)/min(p, 1-p)
+    return weighted_sum(cnf, weights), bound-1
+
+
+# Converts text, a weighted CNF, and counts the result. With a uniform
+# precision, count/2**div*multiplier must be exactly the count with the
+# rounded weights. In any case it must be within the error bound of the
+# exact weighted count.
+def verify(text, precision=7, encoding="chain", error_bound=None, max_vars=MAX_VARS):
+    lines = text.splitlines()
+    orig = read_cnf(lines)
+    out = io.BytesIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ret = Converter(precision=precision, encoding=encoding, error_bound=error_bound).transform(lines, out)
+    conv = read_cnf(out.getvalue().decode().splitlines())
+
+    count = projected_counts(conv["clauses"], conv["show"], max_vars=max_vars)[0]
+    res = {"exact": weighted_count(orig), "count": count, "div": ret.div,
+           "approx": fractions.Fraction(count, 2**ret.div)*conv["multiplier"]}
+    if error_bound is None:
+        res["quantized"], res["bound"] = quantized_count(orig, precision)
+        res["ok"] = res["approx"] == res["quantized"]
+    else:
+        res["bound"] = fractions.Fraction(error_bound)
+        res["ok"] = True
+    if res["exact"] == 0:
+        res["error"] = fractions.Fraction(0 if res["approx"] == 0 else 1)
+    else:
+        res["error"] = abs(res["approx"]-res["exact"])/res["exact"]
+    res["ok"] = res["ok"] and res["error"] <= res["bound"]
+    return res
+
+
+# A random weighted CNF of 2 and 3 literal clauses. Some variables are in
+# no clause, some weights are given for one literal, some for both, and
+# there may be a sampling set and a multiplier. The weights have 3 digits
+# and never round to 0 or 1 at 4 or more bits.
+def random_cnf(rng, num_vars, num_clauses, num_weighted):
+    lines = ["p cnf %d %d" % (num_vars, num_clauses)]
+    weighted = rng.sample(range(1, num_vars+1), num_weighted)
+    if rng.random() < 0.7:
+        rest = [v for v in range(1, num_vars+1) if v not in weighted]
+        show = sorted(weighted + rng.sample(rest, rng.randint(0, len(rest))))
+        lines.append("c p show %s 0" % " ".join(map(str, show)))
+    if rng.random() < 0.2:
+        lines.append("c MUST MULTIPLY BY %d 0" % rng.randint(2, 9))
+    # the first vars are in no clause more often than the others
+    used = list(range(1+rng.randint(0, num_vars//4), num_vars+1))
+    for _ in range(num_clauses):
+        lits = rng.sample(used, min(len(used), rng.randint(2, 3)))
+        lines.append(" ".join("%d" % (v*rng.choice((-1, 1))) for v in lits) + " 0")
+
+    for var in weighted:
+        p = fractions.Fraction(rng.randint(50, 950), 1000)
+        how = rng.random()
+        if how < 0.4:
+            lines.append("c p weight %d %s 0" % (var, decimal_str(p)))
+        elif how < 0.6:
+            lines.append("c p weight %d %s 0" % (-var, decimal_str(1-p)))
+        else:
+            total = rng.choice(TOTALS)
+            lines.append("c p weight %d %s 0" % (var, decimal_str(p*total)))
+            lines.append("c p weight %d %s 0" % (-var, decimal_str((1-p)*total)))
+    return "\n".join(lines) + "\n"
+
+
+# x has a finite decimal expansion, which this is exactly
+def decimal_str(x):
+    return str(decimal.Decimal(x.numerator)/decimal.Decimal(x.denominator))
+
+
+# Verifies instances random CNFs and returns (failed, skipped). The
+# instances get as many weighted variables as encodings of prec bits fit
+# into max_vars, those that still convert to more are skipped.
+def fuzz(instances, seed, precisions, encodings, error_bound=None, max_vars=FUZZ_VARS):
+    rng = random.Random(seed)
+    failed = 0
+    skipped = 0
+    for n in range(instances):
+        prec = rng.choice(precisions)
+        encoding = rng.choice(encodings)
+        # the compact encoding has about one auxiliary variable per 2 bits
+        per_weight = prec+prec//2 if encoding == "compact" else prec
+        num_vars = rng.randint(2, max(2, min(8, max_vars-per_weight)))
+        num_weighted = rng.randint(1, max(1, min(num_vars, (max_vars-num_vars)//per_weight)))
+        text = random_cnf(rng, num_vars, rng.randint(1, 3*num_vars), num_weighted)
+        try:
+            res = verify(text, prec, encoding, error_bound, max_vars)
+        except ValueError:
+            skipped += 1
+            continue
+        if not res["ok"]:
+            failed += 1
+            print("FAILED: instance %d, --prec %d --encoding %s" % (n, prec, encoding))
+            print(text, end="")
+            print("exact: %s approx: %s error: %s bound: %s" % (
+                res["exact"], res["approx"], float(res["error"]), float(res["bound"])))
+    return failed, skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", help="Number of random CNFs. Default: 1000", type=int, default=1000)
+    parser.add_argument("--seed", help="Random number generator seed", type=int, default=1)
+    parser.add_argument("--prec", help="Precisions to pick from. Default: 10 12 14 16",
+                        type=int, nargs="+", default=[10, 12, 14, 16])
+    parser.add_argument("--encoding", help="Encodings to pick from. Default: all",
+                        choices=ENCODINGS, nargs="+", default=ENCODINGS)
+    parser.add_argument("--error-bound", help="Convert with this --error-bound instead of a uniform --prec",
+                        type=float, dest="error_bound")
+    parser.add_argument("--max-vars", help="Most variables of a converted CNF, at most %d. Default: %d" % (MAX_VARS, FUZZ_VARS),
+                        type=int, default=FUZZ_VARS, dest="max_vars")
+    args = parser.parse_args()
+
+    if args.max_vars > MAX_VARS:
+        print("ERROR: --max-vars can be at most %d" % MAX_VARS)
+        exit(-1)
+
+    if min(args.prec) < 4:
+        print("ERROR: --prec must be at least 4, else weights round to 0 or 1")
+        exit(-1)
+
+    failed, skipped = fuzz(args.instances, args.seed, args.prec, args.encoding, args.error_bound, args.max_vars)
+    print("Verified %d instances, %d failed, %d skipped as too large" % (args.instances-skipped, failed, skipped))
+    exit(0 if failed == 0 else -1)
@@ -29,8 +29,108 @@
 
 import time
 import argparse
+import array
+import bz2
+import collections
+import contextlib
+import copy
+import cProfile
 import decimal
+import fractions
+import glob
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import lzma
+import math
+import mmap
+import multiprocessing
+import os
 import re
+import shlex
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+import warnings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# the input is read in blocks of this size, cut at line boundaries
+BLOCK_SIZE = 4*1024*1024
+
+# lines the line-by-line parser has to look at: everything that does not
+# start like a clause (header, comments, weights, empty lines, whitespace)
+SPECIAL_LINE = re.compile(rb'^(?:[^-0-9\n].*)?\n', re.M)
+
+# a comment line of the spool
+COMMENT_LINE = re.compile(rb'^c.*\n', re.M)
+
+# a line with exactly two tokens, i.e. a unit clause
+UNIT_CLAUSE = re.compile(rb'^[^ \n]+ [^ \n]+\n', re.M)
+
+# clause lines with any of these are not already in the normalised form we
+# write out, so they go through the line-by-line parser
+IRREGULAR_WS = (b'  ', b' \n', b'\t', b'\r', b'\x0b', b'\x0c', b'\x1c', b'\x1d', b'\x1e', b'\x1f')
+
+# adaptive precision never gives a weight more bits than this
+MAX_ADAPTIVE_PREC = 256
+
+# quantize_weights() uses NumPy from this many distinct weights on
+NUMPY_MIN_WEIGHTS = 1000
+
+# the smallest show line that is deduplicated with numpy
+NUMPY_MIN_SHOW = 10000
+
+# variables per write of the show line
+SHOW_CHUNK = 1000000
+
+# the smallest input that --parse-jobs splits up
+PARALLEL_MIN_SIZE = 4*BLOCK_SIZE
+
+# the original clauses are kept in memory up to this size, then on disk
+SPOOL_SIZE = 64*1024*1024
+
+# the parse cache files of --parse-cache start and end with this, the
+# version is bumped whenever their layout changes
+PARSE_CACHE_MAGIC = b"W2UCNF\0\0"
+PARSE_CACHE_VERSION = 2
+
+# part of the key of every --result-cache entry, bumped whenever the output
+# of a conversion changes, so that older results are not used any more
+CONVERTER_VERSION = 1
+
+# default size bound of --result-cache, in MB
+RESULT_CACHE_SIZE = 10*1024
+
+# the layout of the index of --indexed outputs, bumped whenever it changes
+INDEX_VERSION = 1
 
 
 class RetVal:
@@ -42,11 +142,1210 @@ class RetVal:
         self.div = div
 
 
+# The result of Converter.convert(). Clause i is lits[offsets[i]:offsets[i+1]],
+# the literals carry no closing 0s. The weighted count is the projected count
+# over show (a ShowSet), divided by 2**div and multiplied by multiplier.
+# From PreparedCNF.convert(), the CNF's own clauses are in base_lits and
+# base_offsets instead, which all its conversions share and must not be
+# changed, and lits and offsets only hold the clauses added to them.
+class ConvertedCNF(RetVal):
+    def __init__(self, origVars, origCls, vars, totalCount, div, lits, offsets, show, multiplier,
+                 base_lits=None, base_offsets=None):
+        super().__init__(origVars, origCls, vars, totalCount, div)
+        self.lits = lits
+        self.offsets = offsets
+        self.show = show
+        self.multiplier = multiplier
+        self.base_lits = base_lits
+        self.base_offsets = base_offsets
+
+    def num_clauses(self):
+        if self.base_offsets is None:
+            return len(self.offsets)-1
+        return len(self.base_offsets)-1 + len(self.offsets)-1
+
+    def clauses(self):
+        if self.base_offsets is not None:
+            for i in range(len(self.base_offsets)-1):
+                yield self.base_lits[self.base_offsets[i]:self.base_offsets[i+1]].tolist()
+        for i in range(len(self.offsets)-1):
+            yield self.lits[self.offsets[i]:self.offsets[i+1]].tolist()
+
+
+# The result of Converter.count(): count is the projected count the counter
+# printed, weighted is count/2**div*multiplier, as an exact Fraction.
+class CountedCNF(RetVal):
+    def __init__(self, ret, multiplier, count):
+        super().__init__(ret.origVars, ret.origCls, ret.vars, ret.totalCount, ret.div)
+        self.multiplier = multiplier
+        self.count = count
+        self.weighted = count*fractions.Fraction(multiplier)/2**ret.div
+
+
+# The sampling set: the variables of the "c p show" lines in the order they
+# were first seen, then runs of consecutive variables added in bulk, i.e.
+# all variables if there was no show line and the chain variables. Whether
+# a listed variable was seen is kept in a bitmap.
+class ShowSet:
+    def __init__(self):
+        self.vars = array.array('i')
+        self.seen = bytearray()
+        self.ranges = []
+
+    def add(self, var):
+        if var in self:
+            return
+        byte = var >> 3
+        if byte >= len(self.seen):
+            self.seen.extend(bytes(max(byte+1, 2*len(self.seen)) - len(self.seen)))
+        self.seen[byte] |= 1 << (var & 7)
+        self.vars.append(var)
+
+    def update(self, vars):
+        if len(vars) == 0:
+            return
+        if len(self.ranges) > 0:
+            vars = [var for var in vars if var not in self]
+        need = (max(vars) >> 3) + 1
+        if need > len(self.seen):
+            self.seen.extend(bytes(max(need, 2*len(self.seen)) - len(self.seen)))
+        if np is not None and len(vars) >= NUMPY_MIN_SHOW:
+            self.update_numpy(vars)
+            return
+        seen = self.seen
+        new = self.vars
+        for var in vars:
+            byte = var >> 3
+            bit = 1 << (var & 7)
+            if not seen[byte] & bit:
+                seen[byte] |= bit
+                new.append(var)
+
+    def update_numpy(self, vars):
+        a = np.array(vars, dtype=np.int64)
+        # first occurrences, in order
+        first = np.unique(a, return_index=True)[1]
+        first.sort()
+        a = a[first]
+        seen = np.frombuffer(self.seen, dtype=np.uint8)
+        a = a[(seen[a >> 3] & (1 << (a & 7))) == 0]
+        bits = np.zeros(len(seen)*8, dtype=bool)
+        bits[a] = True
+        seen |= np.packbits(bits, bitorder='little')
+        # the view has to go before the bitmap can grow again
+        del seen
+        self.vars.frombytes(a.astype(np.int32).tobytes())
+
+    # lo..hi, none of which may be in the set yet
+    def add_range(self, lo, hi):
+        if hi < lo:
+            return
+        if len(self.ranges) > 0 and self.ranges[-1][1]+1 == lo:
+            self.ranges[-1] = (self.ranges[-1][0], hi)
+        else:
+            self.ranges.append((lo, hi))
+
+    def __contains__(self, var):
+        byte = var >> 3
+        if byte < len(self.seen) and self.seen[byte] & (1 << (var & 7)):
+            return True
+        return any(lo <= var <= hi for lo, hi in self.ranges)
+
+    def __len__(self):
+        return len(self.vars) + sum(hi-lo+1 for lo, hi in self.ranges)
+
+    def __iter__(self):
+        yield from self.vars
+        for lo, hi in self.ranges:
+            yield from range(lo, hi+1)
+
+    def copy(self):
+        other = ShowSet()
+        other.vars = array.array('i', self.vars)
+        other.seen = bytearray(self.seen)
+        other.ranges = list(self.ranges)
+        return other
+
+    # pieces of the body of the show line, "1 2 3 ", a million variables
+    # at a time
+    def format(self):
+        parts = [self.vars[i:i+SHOW_CHUNK] for i in range(0, len(self.vars), SHOW_CHUNK)]
+        for lo, hi in self.ranges:
+            parts += [range(i, min(i+SHOW_CHUNK-1, hi)+1) for i in range(lo, hi+1, SHOW_CHUNK)]
+        for part in parts:
+            yield (' '.join(map(str, part)) + ' ').encode()
+
+    # runs of consecutive variables as (first, last) pairs, in order
+    def to_ranges(self):
+        runs = []
+        for var in self.vars:
+            if len(runs) > 0 and runs[-1][1]+1 == var:
+                runs[-1][1] = var
+            else:
+                runs.append([var, var])
+        for lo, hi in self.ranges:
+            if len(runs) > 0 and runs[-1][1]+1 == lo:
+                runs[-1][1] = hi
+            else:
+                runs.append([lo, hi])
+        return [tuple(run) for run in runs]
+
+
+# what the single pass over the input CNF collects
+class ParsedCNF:
+    def __init__(self):
+        self.vars = 0
+        self.cls = 0
+        self.found_header = False
+        self.found_sampl_set = False
+        self.multiplier = None
+        self.maxvar = 0
+        self.num_clauses = 0
+        # the literals of the clauses, without their closing 0s
+        self.num_lits = 0
+        self.num_lines = 0
+        self.headers = 0
+        self.weights = {}
+        # occurs[var] is 1 if var is in a clause, see add_occurrences()
+        self.occurs = bytearray(1)
+        # the lines the weights and the multiplier are on, only kept by
+        # scan_chunk()
+        self.weight_lines = None
+        self.multiplier_line = 0
+        # The original clauses and comments, written out unchanged, as
+        # (fd, offset, length) segments. Runs of clauses that need no
+        # normalization are copied straight from the input file (src, a
+        # duplicate of its fd), everything else goes through the spool (fd
+        # None).
+        self.body = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self.body_size = 0
+        self.src = None
+        self.segments = []
+        # when loaded from a parse cache: the mapped file and where the clause
+        # buffers are in it, see load_parsed()
+        self.cache_map = None
+        self.cached_buffers = None
+
+    # the header is known, so is the size of the occurrence bitmap
+    def set_header(self, vars, cls):
+        self.vars = vars
+        self.cls = cls
+        self.found_header = True
+        self.occurs = bytearray(vars+1)
+
+    # Marks the variables of lits, from a clause or a run_lits(), as
+    # occurring in a clause. Variables above the header's are not marked,
+    # parse() rejects those anyway.
+    def add_occurrences(self, lits):
+        if np is not None and isinstance(lits, np.ndarray):
+            vars = np.abs(lits)
+            maxvar = int(vars.max())
+            if maxvar < len(self.occurs):
+                np.frombuffer(self.occurs, dtype=np.uint8)[vars] = 1
+        else:
+            maxvar = max(max(lits), -min(lits))
+            if maxvar < len(self.occurs):
+                occurs = self.occurs
+                for lit in lits:
+                    occurs[lit if lit > 0 else -lit] = 1
+        self.maxvar = max(self.maxvar, maxvar)
+
+    # the occurrence bitmap, packed to be sent from a worker process
+    def packed_occurrences(self):
+        if np is not None:
+            return np.packbits(np.frombuffer(self.occurs, dtype=np.uint8)).tobytes()
+        return bytes(self.occurs)
+
+    def merge_occurrences(self, packed):
+        if np is not None:
+            bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=len(self.occurs))
+            occurs = np.frombuffer(self.occurs, dtype=np.uint8)
+            occurs |= bits
+        else:
+            merged = int.from_bytes(self.occurs, 'little') | int.from_bytes(packed, 'little')
+            self.occurs = bytearray(merged.to_bytes(len(self.occurs), 'little'))
+
+    def occurs_in_clause(self, var):
+        return var < len(self.occurs) and self.occurs[var] == 1
+
+    # the file offset the stream will be read from, if it is a plain file
+    # that clause runs can later be copied from, otherwise None
+    def passthrough_from(self, f):
+        if not isinstance(f, io.BufferedReader) or not isinstance(f.raw, io.FileIO):
+            return None
+        try:
+            if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                return None
+            pos = f.tell()
+        except (OSError, ValueError):
+            return None
+        self.src = os.dup(f.fileno())
+        return pos
+
+    def add_segment(self, fd, offset, length):
+        if len(self.segments) > 0:
+            last_fd, last_offset, last_length = self.segments[-1]
+            if last_fd == fd and last_offset+last_length == offset:
+                self.segments[-1] = (fd, last_offset, last_length+length)
+                return
+        self.segments.append((fd, offset, length))
+
+    def write_body(self, data):
+        self.body.write(data)
+        self.add_segment(None, self.body_size, len(data))
+        self.body_size += len(data)
+
+    # data is at offset of the input file, if offset is not None
+    def add_run(self, data, offset):
+        if self.src is None or offset is None:
+            self.write_body(data)
+        else:
+            self.add_segment(self.src, offset, len(data))
+
+    # Called before fname is written. If the body is copied from fname, i.e.
+    # the CNF is converted in place, it is read into the spool first, as
+    # opening fname for writing truncates it.
+    def detach_from(self, fname):
+        if self.src is None:
+            return
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return
+        src = os.fstat(self.src)
+        if (st.st_dev, st.st_ino) != (src.st_dev, src.st_ino):
+            return
+        segments = self.segments
+        self.segments = []
+        self.body.seek(self.body_size)
+        for fd, offset, length in segments:
+            if fd is None:
+                self.add_segment(None, offset, length)
+                continue
+            for pos in range(offset, offset+length, BLOCK_SIZE):
+                self.write_body(read_range(fd, pos, min(BLOCK_SIZE, offset+length-pos)))
+        os.close(self.src)
+        self.src = None
+
+    def read_body(self):
+        self.body.flush()
+        parts = []
+        for fd, offset, length in self.segments:
+            if fd is None:
+                self.body.seek(offset)
+                parts.append(self.body.read(length))
+            else:
+                parts.append(read_range(fd, offset, length))
+        return b''.join(parts)
+
+    # writes the body to f, kernel-side where both ends are plain files
+    def copy_body(self, f):
+        dst = plain_fd(f) if self.src is not None else None
+        for fd, offset, length in self.segments:
+            if fd is None:
+                self.body.seek(offset)
+                copy_bytes(self.body, f, length)
+            elif dst is not None:
+                f.flush()
+                copy_range(fd, dst, offset, length)
+            else:
+                for pos in range(offset, offset+length, BLOCK_SIZE):
+                    f.write(read_range(fd, pos, min(BLOCK_SIZE, offset+length-pos)))
+        if dst is not None:
+            # the buffered writer has to learn where the kernel left off
+            f.seek(0, io.SEEK_END)
+
+    # the clauses as flat buffers, see clause_buffers()
+    def clause_buffers(self):
+        if self.cached_buffers is None:
+            return clause_buffers(self.read_body())
+        lits = array.array('i')
+        offsets = array.array('q')
+        (lits_at, lits_len), (offsets_at, offsets_len) = self.cached_buffers
+        with memoryview(self.cache_map) as mv:
+            lits.frombytes(mv[lits_at:lits_at+lits_len])
+            offsets.frombytes(mv[offsets_at:offsets_at+offsets_len])
+        return lits, offsets
+
+    def close(self):
+        self.body.close()
+        if self.src is not None:
+            os.close(self.src)
+            self.src = None
+        if self.cache_map is not None:
+            self.cache_map.close()
+            self.cache_map = None
+
+
+def read_range(fd, offset, length):
+    parts = []
+    while length > 0:
+        data = os.pread(fd, min(length, BLOCK_SIZE), offset)
+        if not data:
+            print("ERROR: The input CNF got shorter while it was being converted")
+            exit(-1)
+        parts.append(data)
+        offset += len(data)
+        length -= len(data)
+    return b''.join(parts)
+
+
+def copy_bytes(src, f, length):
+    while length > 0:
+        data = src.read(min(length, BLOCK_SIZE))
+        f.write(data)
+        length -= len(data)
+
+
+# the fd of a binary file object that writes straight to a plain file
+def plain_fd(f):
+    if not isinstance(f, (io.BufferedWriter, io.BufferedRandom)) or not isinstance(f.raw, io.FileIO):
+        return None
+    try:
+        if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+            return None
+    except (OSError, ValueError):
+        return None
+    return f.fileno()
+
+
+# copies length bytes at offset of src to the current position of dst,
+# without them passing through Python where the OS allows
+def copy_range(src, dst, offset, length):
+    end = offset+length
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                n = os.copy_file_range(src, dst, end-offset, offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError:
+            pass
+    if hasattr(os, "sendfile"):
+        try:
+            while offset < end:
+                n = os.sendfile(dst, src, offset, end-offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError:
+            pass
+    while offset < end:
+        data = read_range(src, offset, min(BLOCK_SIZE, end-offset))
+        os.write(dst, data)
+        offset += len(data)
+
+
+# (sha256, size) of a file, what its parse cache is keyed and checked by
+def source_key(fname):
+    h = hashlib.sha256()
+    size = 0
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            h.update(data)
+            size += len(data)
+    return h.hexdigest(), size
+
+
+# A parse cache file is the sections below, each 8 byte aligned, then a JSON
+# index of them with the header, multiplier and source key, then the
+# index's length and the magic:
+#   body     the original clauses and comments, as written out
+#   lits     int32 literals of the clauses, offsets int64 clause starts, as
+#            clause_buffers() returns them
+#   occurs   the occurrence bitmap
+#   showVars int32 listed show variables in order, showSeen their bitmap
+#   weightLits int32 weighted literals, weightVals their weights as text
+def save_parsed(fname, key, cnf, show):
+    tmp = "%s.%d.tmp" % (fname, os.getpid())
+    try:
+        write_parsed(tmp, key, cnf, show)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def write_parsed(tmp, key, cnf, show):
+    sections = {}
+    # read as well, the clause buffers are built from the body written
+    with open(tmp, 'w+b') as f:
+        f.write(PARSE_CACHE_MAGIC)
+
+        def section(name):
+            f.write(bytes(-f.tell() % 8))
+            sections[name] = [f.tell(), 0]
+            return sections[name]
+
+        body = section("body")
+        cnf.copy_body(f)
+        body[1] = f.tell()-body[0]
+
+        # the clause buffers a block at a time, the clause starts go to a
+        # second file until the literals are all written
+        lits = section("lits")
+        with tempfile.TemporaryFile() as starts:
+            starts.write(array.array('q', [0]).tobytes())
+            pos = body[0]
+            end = body[0]+body[1]
+            num_lits = 0
+            carry = b''
+            f.flush()
+            while pos < end:
+                data = carry + read_range(f.fileno(), pos, min(BLOCK_SIZE, end-pos))
+                pos += len(data)-len(carry)
+                cut = data.rfind(b'\n')+1 if pos < end else len(data)
+                carry = data[cut:]
+                if cut == 0:
+                    continue
+                block_lits, block_offsets = clause_buffers(data[:cut])
+                f.write(block_lits.tobytes())
+                if np is not None:
+                    starts.write((np.frombuffer(block_offsets, dtype=np.int64)[1:] + num_lits).tobytes())
+                else:
+                    starts.write(array.array('q', [num_lits+off for off in block_offsets[1:]]).tobytes())
+                num_lits += len(block_lits)
+            lits[1] = f.tell()-lits[0]
+            offsets = section("offsets")
+            starts.seek(0)
+            while True:
+                data = starts.read(BLOCK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+            offsets[1] = f.tell()-offsets[0]
+
+        for name, data in (("occurs", cnf.occurs), ("showVars", show.vars.tobytes()),
+                           ("showSeen", show.seen),
+                           ("weightLits", array.array('i', cnf.weights.keys()).tobytes()),
+                           ("weightVals", "\n".join(str(val) for val in cnf.weights.values()).encode())):
+            sec = section(name)
+            f.write(data)
+            sec[1] = len(data)
+
+        index = {"version": PARSE_CACHE_VERSION, "sha256": key[0], "size": key[1],
+                 "byteorder": sys.byteorder, "vars": cnf.vars, "cls": cnf.cls, "maxvar": cnf.maxvar,
+                 "numClauses": cnf.num_clauses, "numLits": cnf.num_lits, "numLines": cnf.num_lines,
+                 "foundSamplSet": cnf.found_sampl_set,
+                 "multiplier": None if cnf.multiplier is None else str(cnf.multiplier),
+                 "showRanges": show.ranges, "sections": sections}
+        data = json.dumps(index).encode()
+        f.write(data)
+        f.write(struct.pack('<Q', len(data)))
+        f.write(PARSE_CACHE_MAGIC)
+
+
+# The (ParsedCNF, ShowSet) of a parse cache file, None if it is not there or
+# not for key. The body is copied from the file, the rest is read from a
+# mapping of it.
+def load_parsed(fname, key):
+    try:
+        fd = os.open(fname, os.O_RDONLY)
+    except OSError:
+        return None
+    cnf = ParsedCNF()
+    cnf.src = fd
+    try:
+        cnf.cache_map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        mm = cnf.cache_map
+        if mm[:8] != PARSE_CACHE_MAGIC or mm[-8:] != PARSE_CACHE_MAGIC:
+            raise ValueError("not a parse cache")
+        index_len = struct.unpack('<Q', mm[-16:-8])[0]
+        index = json.loads(mm[-16-index_len:-16])
+        if (index["version"] != PARSE_CACHE_VERSION or index["byteorder"] != sys.byteorder
+                or (index["sha256"], index["size"]) != tuple(key)):
+            raise ValueError("stale parse cache")
+
+        def section(name):
+            at, length = index["sections"][name]
+            return mm[at:at+length]
+
+        cnf.vars = index["vars"]
+        cnf.cls = index["cls"]
+        cnf.found_header = True
+        cnf.headers = 1
+        cnf.maxvar = index["maxvar"]
+        cnf.num_clauses = index["numClauses"]
+        cnf.num_lits = index["numLits"]
+        cnf.num_lines = index["numLines"]
+        cnf.found_sampl_set = index["foundSamplSet"]
+        if index["multiplier"] is not None:
+            cnf.multiplier = decimal.Decimal(index["multiplier"])
+        cnf.occurs = bytearray(section("occurs"))
+        lits = array.array('i')
+        lits.frombytes(section("weightLits"))
+        vals = section("weightVals").decode().split("\n") if len(lits) > 0 else []
+        cnf.weights = dict(zip(lits.tolist(), map(decimal.Decimal, vals)))
+        at, length = index["sections"]["body"]
+        if length > 0:
+            cnf.segments.append((fd, at, length))
+        cnf.cached_buffers = (index["sections"]["lits"], index["sections"]["offsets"])
+
+        show = ShowSet()
+        show.vars.frombytes(section("showVars"))
+        show.seen = bytearray(section("showSeen"))
+        show.ranges = [tuple(r) for r in index["showRanges"]]
+    except (ValueError, KeyError, TypeError, struct.error, decimal.InvalidOperation, OSError):
+        cnf.close()
+        return None
+    return cnf, show
+
+
+# compressed CNFs are read and written through these, picked by extension
+CODECS = {
+    ".gz": lambda fname, mode: gzip.open(fname, mode, compresslevel=6),
+    ".xz": lzma.open,
+    ".lzma": lzma.open,
+    ".bz2": bz2.open,
+}
+
+
+# open a CNF in binary mode, compressed or not
+def open_cnf(fname, mode):
+    for ext, codec in CODECS.items():
+        if fname.endswith(ext):
+            return codec(fname, mode)
+    return open(fname, mode)
+
+
+def is_cnf_name(fname):
+    return any(fname.endswith(".cnf" + ext) for ext in [""] + list(CODECS))
+
+
+# the name of shard i of --split, or with i None of its manifest, e.g.
+# out.cnf.gz -> out.3.cnf.gz and out.manifest.json
+def shard_name(outputFile, i):
+    stem, ext = outputFile, ""
+    for e in [".cnf" + codec for codec in CODECS] + [".cnf"]:
+        if outputFile.endswith(e):
+            stem, ext = outputFile[:-len(e)], e
+            break
+    if i is None:
+        return stem + ".manifest.json"
+    return "%s.%d%s" % (stem, i, ext)
+
+
+# the fractions of the bit_mult assignments of a chain's variables that
+# make its weighted variable true, and of the others, that have bit 0 of
+# the chain, its last variable, set to b
+def split_ratios(chain, b):
+    bit_mult, rest = chain.bit_mult, 2**chain.bit_prec-chain.bit_mult
+    up = 1 if b == 1 else -1
+    if isinstance(chain, CompactTemplate):
+        return fractions.Fraction(bit_mult-up, 2*bit_mult), fractions.Fraction(rest+up, 2*rest)
+    return fractions.Fraction(bit_mult+up, 2*bit_mult), fractions.Fraction(rest+up, 2*rest)
+
+
+# The weighted count of a --split manifest, given the count of each shard in
+# the order of the manifest
+def combine_counts(manifest, counts):
+    if len(counts) != len(manifest["shards"]):
+        raise ValueError("%d counts for %d shards" % (len(counts), len(manifest["shards"])))
+    return fractions.Fraction(sum(counts), 2**manifest["div"])*fractions.Fraction(manifest["multiplier"])
+
+
+# A --result-cache directory holds, for each key, KEY.out, the output file
+# as it was written, and KEY.json with its RetVal, its size and the stats of
+# the conversion. The mtime of KEY.json is when the entry was last used, the
+# least recently used entries are evicted once the directory is larger than
+# its bound. stats.json counts hits, misses and evictions over all runs.
+def result_key(source, options, outputFile):
+    ext = [ext for ext in CODECS if outputFile.endswith(ext)]
+    key = {"sha256": source[0], "size": source[1], "version": CONVERTER_VERSION,
+           "output": ext[0] if ext else "", "options": options}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+# Puts the cached output of key at outputFile, as a hard link if link and
+# the file system allows it, else as a copy. Returns the entry's JSON, or
+# None if there is no complete entry.
+def load_result(cache_dir, key, outputFile, link):
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(entry + ".json", 'r') as f:
+            meta = json.load(f)
+        if os.stat(entry + ".out").st_size != meta["size"]:
+            raise ValueError("truncated result")
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    if link:
+        tmp = "%s.%d.tmp" % (outputFile, os.getpid())
+        try:
+            os.link(entry + ".out", tmp)
+            os.replace(tmp, outputFile)
+            link = True
+        except OSError:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            link = False
+    if not link:
+        with open(entry + ".out", 'rb') as src, open(outputFile, 'wb') as dst:
+            copy_range(src.fileno(), dst.fileno(), 0, meta["size"])
+    try:
+        os.utime(entry + ".json")
+    except OSError:
+        pass
+    return meta
+
+
+# Adds outputFile under key, then evicts the least recently used entries
+# until the cache is at most max_bytes. With link, the entry is a hard link
+# to outputFile, otherwise a copy. A link keeps the mode of outputFile, which
+# the cache does not own.
+def save_result(cache_dir, key, outputFile, meta, link, max_bytes):
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+    tmp = "%s.%d.tmp" % (entry, os.getpid())
+    try:
+        copied = False
+        if link:
+            try:
+                os.link(outputFile, tmp)
+                copied = True
+            except OSError:
+                pass
+        if not copied:
+            with open(outputFile, 'rb') as src, open(tmp, 'wb') as dst:
+                copy_range(src.fileno(), dst.fileno(), 0, os.fstat(src.fileno()).st_size)
+        meta["size"] = os.stat(tmp).st_size
+        os.replace(tmp, entry + ".out")
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, entry + ".json")
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+    evicted = evict_results(cache_dir, max_bytes, key)
+    update_cache_stats(cache_dir, misses=1, evictions=evicted)
+
+
+# Removes the least recently used entries but keep until the cache is at
+# most max_bytes. Returns the number of entries removed.
+def evict_results(cache_dir, max_bytes, keep):
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".json") or name == "stats.json":
+            continue
+        key = name[:-5]
+        try:
+            used = os.stat(os.path.join(cache_dir, name))
+            size = used.st_size + os.stat(os.path.join(cache_dir, key + ".out")).st_size
+        except OSError:
+            continue
+        total += size
+        entries.append((used.st_mtime, key, size))
+
+    evicted = 0
+    for _, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        for ext in (".json", ".out"):
+            try:
+                os.unlink(os.path.join(cache_dir, key + ext))
+            except FileNotFoundError:
+                pass
+        total -= size
+        evicted += 1
+    return evicted
+
+
+# Adds to the counters of stats.json. Runs that share the cache take turns
+# through a lock file where the OS has them.
+def update_cache_stats(cache_dir, **deltas):
+    with open(os.path.join(cache_dir, "stats.lock"), 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        stats = read_cache_stats(cache_dir)
+        for name, delta in deltas.items():
+            stats[name] = stats.get(name, 0) + delta
+        tmp = os.path.join(cache_dir, "stats.json.%d.tmp" % os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(stats, f)
+        os.replace(tmp, os.path.join(cache_dir, "stats.json"))
+
+
+def read_cache_stats(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, "stats.json"), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"hits": 0, "misses": 0, "evictions": 0}
+
+
+# An --indexed output OUT has its index in OUT.index, an SQLite database.
+# Its meta table has the layout of OUT: the width of the padded header, the
+# counts in it, where the multiplier line starts and the exact multiplier,
+# and the size and mtime OUT had when the index was last written. Its
+# weights table has a row for every weighted variable, with the weights
+# declared for its two literals (NULL if not declared) and, unless it is in
+# no clause, where its chain block is: at, size, the clauses of the chain
+# in it and base, the variable before its chain variables.
+def index_name(outputFile):
+    return outputFile + ".index"
+
+
+def write_index(fname, meta, rows):
+    if os.path.exists(fname):
+        os.unlink(fname)
+    db = sqlite3.connect(fname)
+    try:
+        with db:
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value)")
+            db.execute("CREATE TABLE weights (var INTEGER PRIMARY KEY, pos TEXT, neg TEXT, "
+                       "base INTEGER, at INTEGER, size INTEGER, clauses INTEGER)")
+            db.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+            db.executemany("INSERT INTO weights VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    finally:
+        db.close()
+
+
+# The index of outputFile and its meta table, checked to be of this
+# version and to describe outputFile as it is now
+def open_index(outputFile):
+    fname = index_name(outputFile)
+    if sqlite3 is None:
+        print("ERROR: --indexed and --delta need Python's sqlite3 module")
+        exit(-1)
+    if not os.path.exists(fname):
+        print(f"ERROR: {outputFile} has no index {fname}, convert it with --indexed")
+        exit(-1)
+    db = sqlite3.connect(fname)
+    meta = dict(db.execute("SELECT key, value FROM meta"))
+    st = os.stat(outputFile)
+    if meta.get("version") != INDEX_VERSION:
+        print(f"ERROR: The index {fname} is not a version {INDEX_VERSION} index, convert the CNF again with --indexed")
+        exit(-1)
+    if (meta["size"], meta["mtimeNs"]) != (st.st_size, st.st_mtime_ns):
+        print(f"ERROR: {outputFile} was changed after its index {fname} was written, convert the CNF again with --indexed")
+        exit(-1)
+    return db, meta
+
+
+# text, a chain that fits into size bytes, padded to exactly that with a
+# comment line. A single byte is a space at the end of its last clause, as
+# a comment line has at least 2 bytes.
+def fill_block(text, size):
+    assert len(text) <= size, "the chain does not fit its block"
+    if size == len(text)+1:
+        return text[:-1] + " \n"
+    return text + padding(size-len(text))
+
+
+def padding(size):
+    return "" if size == 0 else "c" + " "*(size-2) + "\n"
+
+
+# Flat literal and clause offset buffers of the clauses in data, in the
+# normalised form of the spool. Comment lines are dropped.
+def clause_buffers(data):
+    data = COMMENT_LINE.sub(b'', data)
+    lits = array.array('i')
+    offsets = array.array('q', [0])
+    if np is not None:
+        toks = np.fromstring(data, dtype=np.int64, sep=' ') if len(data) > 0 else np.zeros(0, dtype=np.int64)
+        ends = np.flatnonzero(toks == 0)
+        lits.frombytes(toks[toks != 0].astype(np.int32).tobytes())
+        offsets.frombytes((ends - np.arange(len(ends))).astype(np.int64).tobytes())
+    else:
+        for lit in map(int, data.split()):
+            if lit == 0:
+                offsets.append(len(lits))
+            else:
+                lits.append(lit)
+    # a last clause without its closing 0
+    if len(lits) > offsets[-1]:
+        offsets.append(len(lits))
+    return lits, offsets
+
+
+# the literals (and closing 0s) of a run of clause lines, a NumPy array if
+# NumPy is there, None if they are not all integers
+def run_lits(run):
+    num_tokens = run.count(b' ') + run.count(b'\n')
+    if np is not None:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                lits = np.fromstring(run, dtype=np.int64, sep=' ')
+        except ValueError:
+            return None
+    else:
+        try:
+            lits = list(map(int, run.split()))
+        except ValueError:
+            return None
+    if len(lits) != num_tokens:
+        return None
+    return lits
+
+
+# The shape of the chain formula for bit_mult/2**bit_prec, as getCNF() builds
+# it, computed in time linear in bit_prec.
+#
+# Bit t of bit_mult belongs to chain variable num_vars+bit_prec-t. getCNF()
+# walks the bits from t=1 upwards: in the first half (var -> ...) every 0 bit
+# starts a new clause and every 1 bit is pushed to all clauses started so
+# far, the second half (-var -> ...) does the same with the bits flipped and
+# negated. Bit 0 (always 1) starts the first clause of both halves,
+# un-negated. So the clause started at bit t holds its own literal, then the
+# pushed literals of all later bits, then the weighted variable.
+#
+# Returns for both halves the sign of its chain literals, the pushed bits, and
+# (start bit, index of the first later pushed bit) for each of its clauses.
+def chain_shape(bit_mult, bit_prec):
+    bit_mult = int(bit_mult)
+    halves = []
+    for start_bit, sign in ((0, 1), (1, -1)):
+        starts = [0]
+        pushed = []
+        for t in range(1, bit_prec):
+            if (bit_mult >> t) & 1 == start_bit:
+                starts.append(t)
+            else:
+                pushed.append(t)
+        clauses = []
+        at = 0
+        for t in starts:
+            while at < len(pushed) and pushed[at] < t:
+                at += 1
+            clauses.append((t, at))
+        halves.append((sign, pushed, clauses))
+    return halves
+
+
+# the clauses of the chain formula, exactly as getCNF() builds them
+def chain_clauses(var, bit_mult, bit_prec, num_vars):
+    for (sign, pushed, clauses), last in zip(chain_shape(bit_mult, bit_prec), (-var, var)):
+        pushed_lits = [sign*(num_vars+bit_prec-t) for t in pushed]
+        for t, at in clauses:
+            own = num_vars+bit_prec if t == 0 else sign*(num_vars+bit_prec-t)
+            yield [own] + pushed_lits[at:] + [last]
+
+
+# the number of clauses and literals of the chain formula
+def chain_size(bit_mult, bit_prec):
+    num_cls = num_lits = 0
+    for sign, pushed, clauses in chain_shape(bit_mult, bit_prec):
+        num_cls += len(clauses)
+        num_lits += sum(2+len(pushed)-at for t, at in clauses)
+    return num_cls, num_lits
+
+
+# The compact encoding of a weight: var <-> X < bit_mult, where X is the
+# number whose bit t is chain variable num_vars+bit_prec-t. Exactly bit_mult
+# of the 2**bit_prec values of X make var true, just like with the chain
+# formula, so the projected count is the same.
+#
+# X < bit_mult is built from bit 0 up, one gate per run of equal bits of
+# bit_mult: after a run of 1s it is the OR of the run's negated chain
+# literals and the gate below, after a run of 0s the AND. Leading 0 bits
+# leave it false. The topmost gate is var itself, the others are auxiliary
+# variables aux, aux+1, ... that are defined exactly, so they do not change
+# any count, and are not in the show set. Each chain variable is in 3
+# clauses, so the size is linear in bit_prec.
+def compact_clauses(var, bit_mult, bit_prec, num_vars, aux):
+    bit_mult = int(bit_mult)
+    runs = []
+    for t in range(bit_prec):
+        bit = (bit_mult >> t) & 1
+        if runs and runs[-1][0] == bit:
+            runs[-1][1].append(t)
+        elif runs or bit == 1:
+            runs.append((bit, [t]))
+
+    below = None
+    for i, (bit, bits) in enumerate(runs):
+        out = var if i == len(runs)-1 else aux+i
+        ins = [-(num_vars+bit_prec-t) for t in bits]
+        if below is not None:
+            ins.append(below)
+        if bit == 1:
+            yield [-out] + ins
+            for l in ins:
+                yield [out, -l]
+        else:
+            yield [out] + [-l for l in ins]
+            for l in ins:
+                yield [-out, l]
+        below = out
+
+
+# num/den rounded half to even, like Decimal.quantize()
+def round_ratio(num, den):
+    q, rem = divmod(num, den)
+    if 2*rem > den or (2*rem == den and q % 2 == 1):
+        q += 1
+    return q
+
+
+# |p-q| / min(p, 1-p) for p = num/den and q = bit_mult/2^bit_prec
+def relative_error(num, den, bit_mult, bit_prec):
+    return abs((num << bit_prec) - bit_mult*den) / (min(num, den-num) << bit_prec)
+
+
+# the smallest precision above prec at which num/den quantizes to a
+# q with 0 < q < 1 and, if err is given, to a smaller error than err
+def next_precision(num, den, prec, err):
+    for b in range(prec+1, MAX_ADAPTIVE_PREC+1):
+        bit_mult = round_ratio(num << b, den)
+        if bit_mult == 0 or bit_mult == 2**b:
+            continue
+        e = relative_error(num, den, bit_mult, b)
+        if err is None or e < err:
+            return b, e
+    return None, None
+
+
+# divide out the factors of 2 of weight/2^prec, but never go below 2^0
+def strip_zeros(weight, prec):
+    if weight == 0:
+        return 0, 0
+    zeros = min((weight & -weight).bit_length()-1, prec)
+    return weight >> zeros, prec-zeros
+
+
+# strip_zeros() for a list of weights, all below 2^63
+def strip_zeros_numpy(weights, prec):
+    weights = np.array(weights, dtype=np.int64)
+    # the lowest set bit is a power of two, frexp() gives its exponent exactly
+    zeros = np.frexp((weights & -weights).astype(np.float64))[1] - 1
+    zeros[weights == 0] = prec
+    zeros = np.minimum(zeros, prec)
+    return list(zip((weights >> zeros).tolist(), (prec-zeros).tolist()))
+
+
+# Peak resident memory of this process in MB, None if not known. ru_maxrss
+# survives exec(), so on Linux VmHWM is used instead.
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    if sys.platform == "darwin":
+        return rss/(1024*1024)
+    return rss/1024
+
+
+# The chain formula of one quantized weight, over chain variables
+# 1..bit_prec and with bit_prec+1 standing in for the weighted variable.
+class ChainTemplate:
+    def __init__(self, bit_mult, bit_prec):
+        self.bit_mult = bit_mult
+        self.bit_prec = bit_prec
+        # no auxiliary variables, see CompactTemplate
+        self.num_aux = 0
+
+        # the same as chain_clauses(), built from format fields: {1}..{bit_prec}
+        # are the chain variables and {bit_prec+1} is the weighted variable
+        fmt = []
+        for (sign, pushed, clauses), last in zip(chain_shape(bit_mult, bit_prec), ('-{%d} 0\n', '{%d} 0\n')):
+            neg = '-' if sign < 0 else ''
+            pushed_fmt = [neg + '{%d} ' % (bit_prec-t) for t in pushed]
+            last = last % (bit_prec+1)
+            for t, at in clauses:
+                own = '{%d} ' % bit_prec if t == 0 else neg + '{%d} ' % (bit_prec-t)
+                fmt.append(own + ''.join(pushed_fmt[at:]) + last)
+        self.num_cls = len(fmt)
+        self.num_lits = chain_size(bit_mult, bit_prec)[1]
+        self.chain_lits = self.num_lits
+        self.fmt = ''.join(fmt)
+
+        # only built when asked for as buffers
+        self.lits = None
+        self.ends = None
+        # only counted when asked for the size, see format_size()
+        self.uses = None
+
+    def format(self, var, num_vars, aux=0):
+        return self.fmt.format(*range(num_vars, num_vars+self.bit_prec+1), var)
+
+    def append_to(self, var, num_vars, aux, lits, offsets):
+        if self.lits is None:
+            self.lits = []
+            self.ends = []
+            for cl in chain_clauses(self.bit_prec+1, self.bit_mult, self.bit_prec, 0):
+                self.lits += cl
+                self.ends.append(len(self.lits))
+
+        v = self.bit_prec+1
+        start = len(lits)
+        lits.extend([var if l == v else -var if l == -v else l+num_vars if l > 0 else l-num_vars
+                     for l in self.lits])
+        offsets.extend([start+end for end in self.ends])
+
+
+# compact_clauses() as a template like ChainTemplate, with the auxiliary
+# variables as the format fields after the weighted variable
+class CompactTemplate:
+    def __init__(self, bit_mult, bit_prec):
+        self.bit_mult = bit_mult
+        self.bit_prec = bit_prec
+
+        v = bit_prec+1
+        self.lits = []
+        self.ends = []
+        for cl in compact_clauses(v, bit_mult, bit_prec, 0, v+1):
+            self.lits += cl
+            self.ends.append(len(self.lits))
+        self.num_cls = len(self.ends)
+        self.num_lits = len(self.lits)
+        self.num_aux = max([abs(l) for l in self.lits] + [v]) - v
+        self.chain_lits = chain_size(bit_mult, bit_prec)[1]
+
+        fmt = []
+        start = 0
+        for end in self.ends:
+            fmt.append(' '.join(('-{%d}' if l < 0 else '{%d}') % abs(l) for l in self.lits[start:end]) + ' 0\n')
+            start = end
+        self.fmt = ''.join(fmt)
+        # only counted when asked for the size, see format_size()
+        self.uses = None
+
+    def format(self, var, num_vars, aux):
+        return self.fmt.format(*range(num_vars, num_vars+self.bit_prec+1), var,
+                               *range(aux, aux+self.num_aux))
+
+    def append_to(self, var, num_vars, aux, lits, offsets):
+        v = self.bit_prec+1
+        shift = aux-v-1
+        start = len(lits)
+        lits.extend([var if l == v else -var if l == -v
+                     else l+num_vars if 0 < l < v else l-num_vars if -v < l < 0
+                     else l+shift if l > 0 else l-shift
+                     for l in self.lits])
+        offsets.extend([start+end for end in self.ends])
+
+
+# the total number of digits of the numbers lo..hi
+def digits_total(lo, hi):
+    total = 0
+    digits = len(str(lo))
+    while lo <= hi:
+        end = min(hi, 10**digits-1)
+        total += (end-lo+1)*digits
+        lo = end+1
+        digits += 1
+    return total
+
+
+# len(chain.format(var, num_vars, aux)) without formatting it: the text
+# around the fields, plus how often each field is used times the digits of
+# the variable that goes there
+def format_size(chain, var, num_vars, aux):
+    if chain.uses is None:
+        uses = collections.Counter(int(f) for f in re.findall(r'\{(\d+)\}', chain.fmt))
+        chain.uses = [uses[i] for i in range(max(uses)+1)]
+        chain.fixed_size = len(re.sub(r'\{\d+\}', '', chain.fmt))
+        chain.chain_uses = sum(chain.uses[1:chain.bit_prec+1])
+
+    p = chain.bit_prec
+    if len(str(num_vars+1)) == len(str(num_vars+p)):
+        size = chain.chain_uses*len(str(num_vars+1))
+    else:
+        size = sum(n*len(str(num_vars+i)) for i, n in enumerate(chain.uses[1:p+1], 1))
+    size += chain.uses[p+1]*len(str(var))
+    size += sum(n*len(str(aux+j)) for j, n in enumerate(chain.uses[p+2:]))
+    return chain.fixed_size+size
+
+
+# the weight encodings of --encoding
+ENCODINGS = ["chain", "compact"]
+
+
 class Converter:
-    def __init__(self, precision, verbose=False):
+    def __init__(self, precision, verbose=False, error_bound=None, parse_jobs=1, encoding="chain",
+                 parse_cache=None, result_cache=None, result_cache_size=RESULT_CACHE_SIZE, result_cache_link=False,
+                 indexed=False):
         self.precision = precision
         self.verbose = verbose
-        self.sampl_set = {}
+        # directory of the binary parse caches of parse_file(), if any
+        self.parse_cache = parse_cache
+        # directory of the converted outputs of transform_file(), if any,
+        # its bound in MB and whether hits are hard links, see save_result()
+        self.result_cache = result_cache
+        self.result_cache_size = result_cache_size
+        self.result_cache_link = result_cache_link
+        # the stats of the conversion a result cache hit was made by
+        self.cached_stats = None
+        # the shards of split_parsed(), as written to its manifest
+        self.manifest = None
+        # write the output for apply_delta(), see write_indexed(), with the
+        # weights as declared, before clean_up_weights(), and the chain
+        # whose block size every block is padded to
+        self.indexed = indexed
+        self.declared_weights = None
+        self.largest_chain = None
+        # "chain" or "compact", see compact_clauses()
+        self.encoding = encoding
+        # the auxiliary variables of the compact encoding come after all
+        # chain variables, from aux_base on, see plan_aux()
+        self.aux_base = None
+        self.aux_vars = 0
+        # worker processes that scan a plain input file in chunks
+        self.parse_jobs = parse_jobs
+        # with an error bound, precision is only the baseline we compare to
+        self.error_bound = error_bound
+        self.achieved_error = None
+        self.uniform_added_vars = None
+        self.uniform_error = None
+        # what the count has to be multiplied by, set by quantize_cnf()
+        self.multiplier = None
+        self.sampl_set = ShowSet()
+        self.chain_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # filled in as the conversion goes, see get_stats()
+        self.phase_times = {}
+        self.counters = {}
+
+    # wall clock time of a phase, added up over all its calls
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_times[name] = self.phase_times.get(name, 0.0) + time.perf_counter()-start
+
+    # everything known about the last conversion, ready for json.dump()
+    def get_stats(self, ret):
+        if self.cached_stats is not None:
+            stats = dict(self.cached_stats, phases={name: round(t, 6) for name, t in self.phase_times.items()},
+                         counters=dict(self.cached_stats["counters"], **self.counters), peakRssMB=peak_rss_mb())
+            stats["counters"].pop("parseCacheHit", None)
+            return stats
+        stats = {"phases": {name: round(t, 6) for name, t in self.phase_times.items()},
+                 "counters": dict(self.counters),
+                 "origVars": ret.origVars, "origCls": ret.origCls,
+                 "addedVars": ret.vars-ret.origVars, "clauses": ret.totalCount, "div": ret.div,
+                 "cacheHits": self.cache_hits, "cacheMisses": self.cache_misses,
+                 "peakRssMB": peak_rss_mb()}
+        if tracemalloc.is_tracing():
+            stats["tracedPeakMB"] = tracemalloc.get_traced_memory()[1]/(1024*1024)
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            stats["topAllocations"] = [str(st) for st in top]
+        if self.error_bound is not None:
+            stats["achievedError"] = self.achieved_error
+            stats["uniformAddedVars"] = self.uniform_added_vars
+            stats["uniformError"] = self.uniform_error
+        return stats
 
     def pushVar(self, var, cnfClauses):
         cnfLen = len(cnfClauses)
@@ -54,6 +1353,8 @@ class Converter:
             cnfClauses[i].append(var)
         return cnfClauses
 
+    # getCNF() and pushVar() are the original, quadratic, chain formula
+    # construction. chain_clauses() generates the same clauses directly.
     def getCNF(self, var, binStr, sign, origVars):
         cnfClauses = []
         binLen = len(binStr)
@@ -69,51 +1370,94 @@ class Converter:
         self.pushVar(var, cnfClauses)
         return cnfClauses
 
-    def encodeCNF(self, var,  bit_mult, bit_prec, num_vars, num_cls, div):
+    # The chain formula only depends on (bit_mult, bit_prec), so it is built
+    # once per distinct pair and instantiated for every variable. The compact
+    # encoding is only used where it is smaller than the chain formula,
+    # which it is not for short chains.
+    def get_chain(self, bit_mult, bit_prec):
+        key = (self.encoding, bit_mult, bit_prec)
+        if key in self.chain_cache:
+            self.cache_hits += 1
+            return self.chain_cache[key]
+        self.cache_misses += 1
+        chain = None
+        if self.encoding == "compact":
+            chain = CompactTemplate(bit_mult, bit_prec)
+            if chain.num_lits >= chain.chain_lits:
+                chain = None
+        if chain is None:
+            chain = ChainTemplate(bit_mult, bit_prec)
+        self.chain_cache[key] = chain
+        return chain
+
+    # The auxiliary variables of the compact encoding are numbered after the
+    # chain variables of all weights, so that those stay one run in the show
+    # set. Called before the chains are encoded.
+    def plan_aux(self, num_vars, chains):
+        self.aux_base = num_vars+1+sum(bit_prec for var, bit_mult, bit_prec in chains
+                                       if (bit_mult, bit_prec) != (1, 1))
+        self.aux_vars = 0
+        if self.encoding == "compact":
+            self.counters["weightLits"] = 0
+            self.counters["chainFormulaLits"] = 0
+            self.counters["auxVars"] = 0
+
+    # the chain variables and the auxiliary variables, once all are encoded
+    def total_vars(self, vars):
+        return vars+self.aux_vars
+
+    # the first auxiliary variable of the next chain
+    def use_chain(self, chain):
+        if chain.num_aux == 0:
+            return 0
+        assert self.aux_base is not None, "plan_aux() must be called before the chains are encoded"
+        aux = self.aux_base+self.aux_vars
+        self.aux_vars += chain.num_aux
+        return aux
+
+    def count_lits(self, chain):
+        if "weightLits" in self.counters:
+            self.counters["weightLits"] += chain.num_lits
+            self.counters["chainFormulaLits"] += chain.chain_lits
+            self.counters["auxVars"] += chain.num_aux
+
+    # the part of encoding a weight that does not depend on the output format
+    def add_chain_vars(self, bit_mult, bit_prec, num_vars):
         # exactly half, i.e. 0.5
         if bit_prec == 1 and bit_mult == 1:
-            return "", num_vars, num_cls, div+1
+            return False
 
         if bit_prec == 0:
             print("ERROR: the formula was not preprocessed by Arjun")
             exit(-1)
 
-        self.sampl_set[num_vars+1] = 1
-        binStr = str(bin(int(bit_mult)))[2:-1]
-        binLen = len(binStr)
-        for i in range(bit_prec-binLen-1):
-            binStr = '0'+binStr
-        for i in range(bit_prec-1):
-            self.sampl_set[num_vars+i+2] = 1
-        complementStr = ''
-        for i in range(len(binStr)):
-            if binStr[i] == '0':
-                complementStr += '1'
-            else:
-                complementStr += '0'
-        origCNFClauses = self.getCNF(-var, binStr, True, num_vars)
-
-        writeLines = ''
-        for i in range(len(origCNFClauses)):
-            num_cls += 1
-            for j in range(len(origCNFClauses[i])):
-                writeLines += str(origCNFClauses[i][j])+' '
-            writeLines += '0\n'
-
-        cnfClauses = self.getCNF(var, complementStr, False, num_vars)
-        for i in range(len(cnfClauses)):
-            if cnfClauses[i] in origCNFClauses:
-                continue
-            num_cls += 1
-            for j in range(len(cnfClauses[i])):
-                writeLines += str(cnfClauses[i][j])+' '
-            writeLines += '0\n'
+        self.sampl_set.add_range(num_vars+1, num_vars+bit_prec)
+        return True
+
+    def encodeCNF(self, var,  bit_mult, bit_prec, num_vars, num_cls, div):
+        if not self.add_chain_vars(bit_mult, bit_prec, num_vars):
+            return "", num_vars, num_cls, div+1
+
+        chain = self.get_chain(bit_mult, bit_prec)
+        writeLines = chain.format(var, num_vars, self.use_chain(chain))
+        self.count_lits(chain)
 
         vars = num_vars+bit_prec
-        return writeLines, vars, num_cls, div+bit_prec
+        return writeLines, vars, num_cls+chain.num_cls, div+bit_prec
 
-    # return (weight:bits ratio, number of bits needed to represent the weight)
-    def quantize_weight(self, init_w):
+    # encodeCNF(), appending to flat literal and clause end buffers
+    def encode_buffers(self, var, bit_mult, bit_prec, num_vars, num_cls, div, lits, offsets):
+        if not self.add_chain_vars(bit_mult, bit_prec, num_vars):
+            return num_vars, num_cls, div+1
+
+        chain = self.get_chain(bit_mult, bit_prec)
+        chain.append_to(var, num_vars, self.use_chain(chain), lits, offsets)
+        self.count_lits(chain)
+        return num_vars+bit_prec, num_cls+chain.num_cls, div+bit_prec
+
+    # init_w * 2^precision, rounded half to even like Decimal.quantize(), but
+    # in exact integer arithmetic
+    def round_weight(self, init_w, precision=None):
         assert type(init_w) == decimal.Decimal
 
         assert self.precision > 1, "Precision must be at least 2"
@@ -121,25 +1465,107 @@ class Converter:
             print(f"ERROR: Weight {init_w} is not in the range [0.0, 1.0]")
             exit(-1)
 
+        if precision is None:
+            precision = self.precision
+        num, den = init_w.as_integer_ratio()
+        return round_ratio(num << precision, den)
+
+    # return (weight:bits ratio, number of bits needed to represent the weight)
+    def quantize_weight(self, init_w):
         if self.verbose:
             print(f"Query for weight {init_w}")
 
-        weight = init_w*pow(2, self.precision)
-        weight = weight.quantize(decimal.Decimal("1"))
-        weight = int(weight)
+        weight = self.round_weight(init_w)
         prec = self.precision
         if self.verbose:
             print(f"Weight {weight} prec {prec}. Generated from {init_w} * 2^{self.precision}")
 
-        while weight % 2 == 0 and prec > 0:
-            weight = weight/2
-            prec -= 1
+        weight, prec = strip_zeros(weight, prec)
 
         if self.verbose:
             print(f"for input weight {init_w} returning: weight: {weight} prec: {prec}")
 
         return weight, prec
 
+    # quantize_weight() for a whole list of weights. Every distinct weight is
+    # only rounded once and with NumPy the trailing zeros of all of them are
+    # stripped at once. precisions, if given, is the precision of each weight.
+    def quantize_weights(self, weights, precisions=None):
+        if precisions is None:
+            distinct = list(dict.fromkeys(weights))
+            rounded = [self.round_weight(w) for w in distinct]
+            if np is not None and self.precision <= 62 and len(rounded) >= NUMPY_MIN_WEIGHTS:
+                quantized = strip_zeros_numpy(rounded, self.precision)
+            else:
+                quantized = [strip_zeros(weight, self.precision) for weight in rounded]
+            quantized = dict(zip(distinct, quantized))
+            return [quantized[w] for w in weights]
+
+        quantized = {}
+        for key in zip(weights, precisions):
+            if key not in quantized:
+                w, prec = key
+                quantized[key] = strip_zeros(self.round_weight(w, prec), prec)
+        return [quantized[key] for key in zip(weights, precisions)]
+
+    # The fewest bits per weight that keep the relative error of the weighted
+    # count within self.error_bound. Quantizing weight p (and 1-p) to q changes
+    # every term of the weighted count by at most a factor 1+-err, where
+    # err = |p-q| / min(p, 1-p), so the count is off by at most
+    # prod(1+err_i) - 1.
+    #
+    # Every variable starts with the fewest bits that give 0 < q < 1. Then we
+    # greedily give more bits to the weight with the largest error reduction
+    # per added bit, until the bound holds. Variables of the same weight are
+    # moved together.
+    def adaptive_precisions(self, weights):
+        budget = math.log1p(self.error_bound)
+        counts = {}
+        for w in weights:
+            counts[w] = counts.get(w, 0) + 1
+
+        bits = {}
+        errs = {}
+        total = 0.0
+        steps = []
+        for w, count in counts.items():
+            num, den = w.as_integer_ratio()
+            b, err = next_precision(num, den, 0, None)
+            bits[w] = b
+            errs[w] = err
+            total += count*math.log1p(err)
+            self.push_precision_step(steps, w, num, den, b, err)
+
+        while total > budget:
+            if len(steps) == 0:
+                print(f"ERROR: Cannot reach relative error {self.error_bound} with at most {MAX_ADAPTIVE_PREC} bits per weight")
+                exit(-1)
+            _, w, b, err = heapq.heappop(steps)
+            total -= counts[w]*(math.log1p(errs[w]) - math.log1p(err))
+            bits[w] = b
+            errs[w] = err
+            num, den = w.as_integer_ratio()
+            self.push_precision_step(steps, w, num, den, b, err)
+
+        return [bits[w] for w in weights]
+
+    def push_precision_step(self, steps, w, num, den, b, err):
+        if err == 0:
+            return
+        next_b, next_err = next_precision(num, den, b, err)
+        if next_b is None:
+            return
+        gain = (math.log1p(err) - math.log1p(next_err))/(next_b-b)
+        heapq.heappush(steps, (-gain, w, next_b, next_err))
+
+    # relative error bound of the weighted count for the given quantization
+    def quantization_error(self, weights, quantized):
+        total = 0.0
+        for w, (bit_mult, bit_prec) in zip(weights, quantized):
+            num, den = w.as_integer_ratio()
+            total += math.log1p(relative_error(num, den, bit_mult, bit_prec))
+        return math.expm1(total)
+
     def delete_1_1_weights(self, w, vars):
         # delete 1/1 weights
         vars2 = {}
@@ -213,176 +1639,930 @@ class Converter:
 
         return mult, w
 
-    #  The code is straightforward chain formula implementation
-    def transform(self, lines, outputFile):
-        orig_cnf_lines = ''
-        vars = 0
-        num_cls = 0
-        div = 0
-        origVars = 0
-        origCls = 0
-        maxvar = 0
-        found_sampl_set = False
-        found_header = False
-        multiplier = None
-        for line in lines:
-            line = line.strip()
-            line = re.sub(r'\s+', ' ', line)
+    # one pass over the input: header, sampling set, multiplier and weights
+    # are collected, the original clauses go straight to the spool
+    def parse(self, lines):
+        cnf = ParsedCNF()
+        # the spool and the input fd are not left open on errors
+        try:
+            if isinstance(lines, (io.RawIOBase, io.BufferedIOBase)):
+                start = cnf.passthrough_from(lines)
+                if not self.parse_stream(lines, cnf, start):
+                    # the chunks could not be merged, start over in one go
+                    cnf.close()
+                    cnf = ParsedCNF()
+                    self.sampl_set = ShowSet()
+                    lines.seek(start)
+                    self.parse_stream(lines, cnf, cnf.passthrough_from(lines), parallel=False)
+            else:
+                try:
+                    for line in lines:
+                        self.parse_line(line, cnf)
+                except SystemExit:
+                    print(f"ERROR: The problem is on line {cnf.num_lines} of the CNF")
+                    raise
+
+            if cnf.multiplier is None:
+                cnf.multiplier = decimal.Decimal('1')
+
+            if cnf.maxvar > cnf.vars:
+                print(f"ERROR: CNF contains var {cnf.maxvar} but header says we only have {cnf.vars} vars")
+                exit(-1)
+
+            print(f"Header says vars: {cnf.vars}  maximum var used: {cnf.maxvar}")
 
-            if len(line) == 0:
-                print("ERROR: The CNF contains an empty line.")
-                print("ERROR: Empty lines are NOT part of the DIMACS specification")
-                print("ERROR: Remove the empty line so we can parse the CNF")
+            if not cnf.found_header:
+                print("ERROR: No header 'p cnf VARS CLAUSES' found in the CNF!")
                 exit(-1)
 
-            if line[:2] == 'p ':
-                fields = line.split()
-                if (len(fields) != 4 or fields[1] != 'cnf'):
-                    print("ERROR: The CNF header must be of the form 'p cnf VARS CLAUSES'")
-                    exit(-1)
-                vars = int(fields[2])
-                num_cls = int(fields[3])
-                origVars = vars
-                origCls = num_cls
-                found_header = True
-                continue
+            # if "c ind" was not found, then all variables are in the sampling set
+            if not cnf.found_sampl_set:
+                print("WARNING: No sampling set found, assuming all variables are in the sampling set")
+                self.sampl_set.add_range(1, cnf.vars)
+        except SystemExit:
+            cnf.close()
+            raise
+
+        self.count_parsed(cnf)
+        return cnf
+
+    def count_parsed(self, cnf):
+        self.counters["lines"] = cnf.num_lines
+        self.counters["clauses"] = cnf.num_clauses
+        self.counters["weightedLits"] = len(cnf.weights)
+        self.counters["distinctWeights"] = len(set(cnf.weights.values()))
+        self.counters["showVars"] = len(self.sampl_set)
+
+    # parse() of the CNF file fname. With a parse cache, the parsed CNF is
+    # loaded from there if it was parsed before, else parsed and saved there.
+    # The cache file is named and checked by the hash of fname, so a changed
+    # file is never taken from the cache.
+    def parse_file(self, fname):
+        if self.parse_cache is None:
+            with open_cnf(fname, 'rb') as f:
+                return self.parse(f)
+
+        key = source_key(fname)
+        cache = os.path.join(self.parse_cache, key[0] + ".cnfbin")
+        loaded = load_parsed(cache, key)
+        if loaded is not None:
+            cnf, self.sampl_set = loaded
+            print(f"Header says vars: {cnf.vars}  maximum var used: {cnf.maxvar}")
+            if not cnf.found_sampl_set:
+                print("WARNING: No sampling set found, assuming all variables are in the sampling set")
+            self.counters["parseCacheHit"] = 1
+            self.count_parsed(cnf)
+            return cnf
+
+        with open_cnf(fname, 'rb') as f:
+            cnf = self.parse(f)
+        self.counters["parseCacheHit"] = 0
+        try:
+            os.makedirs(self.parse_cache, exist_ok=True)
+            save_parsed(cache, key, cnf, self.sampl_set)
+        except OSError as e:
+            print("WARNING: Could not write the parse cache %s: %s" % (cache, e))
+        return cnf
+
+    # offset is the position of f in the file, None if the file cannot be
+    # read from directly. Returns False if the CNF has to be parsed again
+    # without splitting it up.
+    def parse_stream(self, f, cnf, offset, parallel=True):
+        if parallel and self.parse_jobs > 1 and offset is not None and isinstance(f.name, str):
+            size = os.fstat(f.fileno()).st_size
+            if size-offset >= PARALLEL_MIN_SIZE:
+                return self.parse_parallel(f, cnf, offset, size)
+        self.scan_range(f, cnf, offset, None)
+        return True
+
+    def scan_range(self, f, cnf, offset, end):
+        try:
+            self.parse_range(f, cnf, offset, end)
+        except SystemExit:
+            print(f"ERROR: The problem is on line {cnf.num_lines} of the CNF")
+            raise
+
+    # parses f from offset up to end, or up to the end of the file if end
+    # is None
+    def parse_range(self, f, cnf, offset, end):
+        tail = b''
+        while True:
+            if end is None:
+                buf = f.read(BLOCK_SIZE)
+            else:
+                buf = f.read(min(BLOCK_SIZE, end-offset))
+            if not buf:
+                break
+            start = None
+            if offset is not None:
+                start = offset-len(tail)
+                offset += len(buf)
+            buf = tail + buf
+            cut = buf.rfind(b'\n') + 1
+            tail = buf[cut:]
+            if cut > 0:
+                self.parse_block(buf[:cut], cnf, start)
+        # last line without a newline, which is not in the file as it is
+        if len(tail) > 0:
+            self.parse_block(tail + b'\n', cnf)
+
+    # The header and the first block are parsed here, the rest of the file
+    # is split into newline aligned chunks that are scanned by parse_jobs
+    # worker processes, see scan_chunk(). The results are merged in file
+    # order, so the outcome is the same as that of parsing in one go.
+    def parse_parallel(self, f, cnf, offset, size):
+        first = line_end(f, offset+BLOCK_SIZE, size)
+        f.seek(offset)
+        self.scan_range(f, cnf, offset, first)
+        if not cnf.found_header:
+            # let parse_clauses() complain at the first clause
+            self.scan_range(f, cnf, first, None)
+            return True
+
+        step = max((size-first) // (self.parse_jobs*4), BLOCK_SIZE)
+        bounds = [first]
+        while bounds[-1] < size:
+            bounds.append(line_end(f, bounds[-1]+step, size))
+        jobs = [(f.name, a, b, cnf.vars, cnf.cls) for a, b in zip(bounds, bounds[1:])]
+
+        # At most two chunks per worker are handed out ahead of the merge,
+        # which bounds the memory of unmerged results. On an error the pool
+        # is left to finish those, as terminating it while chunks are queued
+        # can hang.
+        pool = multiprocessing.Pool(self.parse_jobs, initializer=init_worker)
+        todo = iter(jobs)
+        pending = collections.deque(pool.apply_async(scan_chunk, (job,))
+                                    for job in itertools.islice(todo, self.parse_jobs*2))
+        try:
+            while len(pending) > 0:
+                res = pending.popleft().get()
+                if res["headers"] > 0:
+                    return False
+                self.merge_chunk(cnf, res)
+                for job in itertools.islice(todo, 1):
+                    pending.append(pool.apply_async(scan_chunk, (job,)))
+        finally:
+            pool.close()
+            pool.join()
+        return True
+
+    def merge_chunk(self, cnf, res):
+        # (line in the chunk, messages) of the errors, only the first one
+        # in the file is reported, as it would be when parsing in one go
+        errors = []
+        if res["error"] is not None:
+            errors.append((res["lines"], res["error"]))
+        for lit in res["weights"]:
+            if lit in cnf.weights:
+                errors.append((res["weight_lines"][lit], [
+                    f"ERROR: Lit {lit} has TWO weights declared",
+                    "ERROR: You must ONLY declare each literal's weight ONCE"]))
+                break
+        if res["multiplier"] is not None and cnf.multiplier is not None:
+            errors.append((res["multiplier_line"], [
+                f"ERROR: The CNF already has a multiplier defined: {cnf.multiplier}",
+                "ERROR: Please remove the previous multiplier or the new one"]))
+        if len(errors) > 0:
+            line, messages = min(errors, key=lambda e: e[0])
+            for msg in messages:
+                print(msg)
+            print(f"ERROR: The problem is on line {cnf.num_lines+line} of the CNF")
+            exit(-1)
 
-            # parse independent set
-            if line[:8] == "c p show" or line[:5] == "c ind":
-                if line[:8] == "c p show": start = 8
-                else: start = 5
-                found_sampl_set = True
-                for var in line[start:].split():
-                    var = var.strip()
-                    var = int(var)
-                    if var == 0:
-                        break
-                    if var <= 0:
-                        print(f"ERROR: The sampling set contains {var} but sampling vars must be positive")
-                        exit(-1)
-                    if var > vars:
-                        print(f"ERROR: The sampling set contains {var} but header says we only have {vars} vars")
-                        exit(-1)
-                    self.sampl_set[var] = 1
-                continue
+        cnf.weights.update(res["weights"])
+        if res["multiplier"] is not None:
+            cnf.multiplier = res["multiplier"]
+        for var in res["show"]:
+            self.sampl_set.add(var)
+        cnf.found_sampl_set = cnf.found_sampl_set or res["found_sampl_set"]
+
+        cnf.maxvar = max(cnf.maxvar, res["maxvar"])
+        cnf.merge_occurrences(res["occurs"])
+        cnf.num_clauses += res["num_clauses"]
+        cnf.num_lits += res["num_lits"]
+        cnf.num_lines += res["lines"]
+        # the spool of the chunk goes after ours
+        for fd, offset, length in res["segments"]:
+            if fd is None:
+                cnf.write_body(res["body"][offset:offset+length])
+            else:
+                cnf.add_segment(cnf.src, offset, length)
+
+    # runs of clause lines are dealt with in bulk, everything else line by
+    # line. start is the file offset of the block, if it can be copied from.
+    def parse_block(self, block, cnf, start=None):
+        pos = 0
+        for m in SPECIAL_LINE.finditer(block):
+            if m.start() > pos:
+                with self.phase("scan_clauses"):
+                    self.parse_clauses(block[pos:m.start()], cnf, None if start is None else start+pos)
+            with self.phase("scan_lines"):
+                self.parse_text(m.group(), cnf)
+            pos = m.end()
+        if pos < len(block):
+            with self.phase("scan_clauses"):
+                self.parse_clauses(block[pos:], cnf, None if start is None else start+pos)
+
+    def parse_text(self, data, cnf):
+        for line in io.StringIO(data.decode(), newline=None):
+            self.parse_line(line, cnf)
+
+    # a run of lines that all start with a digit or '-', found at offset of
+    # the input file
+    def parse_clauses(self, run, cnf, offset=None):
+        if not cnf.found_header:
+            cnf.num_lines += 1
+            print("ERROR: The 'p cnf VARS CLAUSES' header must be at the top of the CNF!")
+            exit(-1)
 
-            if "c MUST MULTIPLY BY" in line:
-                if multiplier is not None:
-                    print(f"ERROR: The CNF already has a multiplier defined: {multiplier}")
-                    print("ERROR: Please remove the previous multiplier or the new one")
-                    exit(-1)
-                multiplier = self.parse_weight(line.split()[4])
-                continue
+        if any(ws in run for ws in IRREGULAR_WS):
+            self.parse_text(run, cnf)
+            return
+
+        lits = run_lits(run)
+        if lits is None:
+            # let the line parser complain about it
+            self.parse_text(run, cnf)
+            return
+        cnf.add_occurrences(lits)
+
+        m = UNIT_CLAUSE.search(run)
+        if m:
+            cnf.num_lines += run.count(b'\n', 0, m.start()) + 1
+            print("ERROR: The CNF contains a clause with only one literal. This means Arjun has not been run. Exiting.")
+            exit(-1)
 
-            if line[0] == 'c' and line[:4] != 'c t ' and line[:4] != 'c p ':
-                orig_cnf_lines += str(line + '\n')
-                continue
+        num = run.count(b'\n')
+        cnf.num_clauses += num
+        cnf.num_lits += len(lits)-num
+        cnf.num_lines += num
+        cnf.add_run(run, offset)
+
+    def parse_line(self, line, cnf):
+        cnf.num_lines += 1
+        line = line.strip()
+        line = re.sub(r'\s+', ' ', line)
+
+        if len(line) == 0:
+            print("ERROR: The CNF contains an empty line.")
+            print("ERROR: Empty lines are NOT part of the DIMACS specification")
+            print("ERROR: Remove the empty line so we can parse the CNF")
+            exit(-1)
 
-            if not found_header:
-                print("ERROR: The 'p cnf VARS CLAUSES' header must be at the top of the CNF!")
+        if line[:2] == 'p ':
+            fields = line.split()
+            if (len(fields) != 4 or fields[1] != 'cnf'):
+                print("ERROR: The CNF header must be of the form 'p cnf VARS CLAUSES'")
                 exit(-1)
-
-            # an actual clause
-            if line[0].isdigit() or line[0] == '-':
-                for lit in line.split():
-                    maxvar = max(abs(int(lit)), maxvar)
-                if len(line.split()) == 2:
-                    print("ERROR: The CNF contains a clause with only one literal. This means Arjun has not been run. Exiting.")
+            cnf.set_header(int(fields[2]), int(fields[3]))
+            cnf.headers += 1
+            return
+
+        # parse independent set
+        if line[:8] == "c p show" or line[:5] == "c ind":
+            if line[:8] == "c p show": start = 8
+            else: start = 5
+            cnf.found_sampl_set = True
+            # all at once if they are all valid, else one by one to find the
+            # first bad one
+            try:
+                vars = list(map(int, line[start:].split()))
+            except ValueError:
+                vars = None
+            if vars is not None:
+                if 0 in vars:
+                    vars = vars[:vars.index(0)]
+                if len(vars) == 0 or (min(vars) > 0 and max(vars) <= cnf.vars):
+                    self.sampl_set.update(vars)
+                    return
+            for var in line[start:].split():
+                var = var.strip()
+                var = int(var)
+                if var == 0:
+                    break
+                if var <= 0:
+                    print(f"ERROR: The sampling set contains {var} but sampling vars must be positive")
+                    exit(-1)
+                if var > cnf.vars:
+                    print(f"ERROR: The sampling set contains {var} but header says we only have {cnf.vars} vars")
                     exit(-1)
-                orig_cnf_lines += str(line + '\n')
+                self.sampl_set.add(var)
+            return
 
-            # NOTE: we are skipping all the other types of things in the CNF
-            #       for example, the weights
-            continue
+        if "c MUST MULTIPLY BY" in line:
+            if cnf.multiplier is not None:
+                print(f"ERROR: The CNF already has a multiplier defined: {cnf.multiplier}")
+                print("ERROR: Please remove the previous multiplier or the new one")
+                exit(-1)
+            cnf.multiplier = self.parse_weight(line.split()[4])
+            cnf.multiplier_line = cnf.num_lines
+            return
 
-        if multiplier is None:
-            multiplier = decimal.Decimal('1')
+        if line[0] == 'c' and line[:4] != 'c t ' and line[:4] != 'c p ':
+            cnf.write_body(line.encode() + b'\n')
+            return
 
-        if maxvar > vars:
-            print(f"ERROR: CNF contains var {maxvar} but header says we only have {vars} vars")
+        if not cnf.found_header:
+            print("ERROR: The 'p cnf VARS CLAUSES' header must be at the top of the CNF!")
             exit(-1)
 
-        print(f"Header says vars: {vars}  maximum var used: {maxvar}")
+        # an actual clause
+        if line[0].isdigit() or line[0] == '-':
+            cnf.add_occurrences([int(lit) for lit in line.split()])
+            if len(line.split()) == 2:
+                print("ERROR: The CNF contains a clause with only one literal. This means Arjun has not been run. Exiting.")
+                exit(-1)
+            cnf.num_clauses += 1
+            cnf.num_lits += len(line.split())-1
+            cnf.write_body(line.encode() + b'\n')
+            return
+
+        if line[:2] == 'w ' or line[:10] == 'c p weight':
+            if line[:2] == 'w ': start = 2
+            else: start = 10
+            fields = line[start:].split()
+            lit = int(fields[0])
+            val = self.parse_weight(fields[1])
+
+            if lit == 0:
+                print("ERROR: Literal 0 has a weight, but literal 0 is not allowed in CNF")
+                exit(-1)
 
-        if not found_header:
-            print("ERROR: No header 'p cnf VARS CLAUSES' found in the CNF!")
-            exit(-1)
+            # already has been declared, error
+            if lit in cnf.weights:
+                print(f"ERROR: Lit {lit} has TWO weights declared")
+                print("ERROR: You must ONLY declare each literal's weight ONCE")
+                exit(-1)
+            cnf.weights[lit] = val
+            if cnf.weight_lines is not None:
+                cnf.weight_lines[lit] = cnf.num_lines
 
-        # if "c ind" was not found, then all variables are in the sampling set
-        if not found_sampl_set:
-            print("WARNING: No sampling set found, assuming all variables are in the sampling set")
-            for i in range(1, vars+1):
-                self.sampl_set[i] = 1
+        # NOTE: we are skipping all the other types of things in the CNF
+        return
 
-        # weight parsing and CNF generation
+    # the weights can only be checked once the whole CNF has been read, as
+    # the sampling set may come after them
+    def get_weights(self, cnf):
         w = {}
-        new_cnf = ''
-        for line in lines:
-            line = line.strip()
-            line = re.sub(r'\s+', ' ', line)
-
-            if line[:2] == 'w ' or line[:10] == 'c p weight':
-                if line[:2] == 'w ': start = 2
-                else: start = 10
-                fields = line[start:].split()
-                lit = int(fields[0])
-                if abs(lit) > vars:
-                    print(f"ERROR: Literal {lit} has a weight but it is not part of the CNF")
-                    print(f"ERROR: The CNF only has {vars} variables, but literal {lit} is used")
-                    exit(-1)
-                val = self.parse_weight(fields[1])
+        for lit, val in cnf.weights.items():
+            if abs(lit) > cnf.vars:
+                print(f"ERROR: Literal {lit} has a weight but it is not part of the CNF")
+                print(f"ERROR: The CNF only has {cnf.vars} variables, but literal {lit} is used")
+                exit(-1)
+            var = abs(lit)
 
-                if lit == 0:
-                    print("ERROR: Literal 0 has a weight, but literal 0 is not allowed in CNF")
-                    exit(-1)
+            # Model Counting Competition has these. I can't explain this without going on a rant
+            if var not in self.sampl_set:
+                print(f"WARNING: Variable {var} has a weight but is not part of the sampling set. Skipping it!")
+                continue
+            if val == decimal.Decimal("0"):
+                print(f"ERROR: Literal {lit} has a weight of 0, which means the CNF has not been preprocessed by Arjun. Exiting.")
+                exit(-1)
 
-                # already has been declared, error
-                if lit in w:
-                    print(f"ERROR: Lit {lit} has TWO weights declared")
-                    print("ERROR: You must ONLY declare each literal's weight ONCE")
-                    exit(-1)
-                var = abs(lit)
+            w[lit] = val
+        return w
+
+    # transform() of the CNF file fname, through the parse cache if there is
+    # one. With a result cache, the output of an earlier conversion of the
+    # same file with the same options is put at outputFile instead.
+    def transform_file(self, fname, outputFile):
+        if self.result_cache is None:
+            return self.transform_uncached(fname, outputFile)
+
+        with self.phase("result_cache"):
+            options = {"precision": self.precision, "error_bound": self.error_bound, "encoding": self.encoding}
+            key = result_key(source_key(fname), options, outputFile)
+            meta = load_result(self.result_cache, key, outputFile, self.result_cache_link)
+        if meta is not None:
+            print("Output taken from the result cache: %s" % os.path.join(self.result_cache, key + ".out"))
+            self.counters["resultCacheHit"] = 1
+            self.cached_stats = meta["stats"]
+            update_cache_stats(self.result_cache, hits=1)
+            return RetVal(*meta["ret"])
+
+        self.counters["resultCacheHit"] = 0
+        ret = self.transform_uncached(fname, outputFile)
+        with self.phase("result_cache"):
+            stats = self.get_stats(ret)
+            for name in ("phases", "peakRssMB", "tracedPeakMB", "topAllocations"):
+                stats.pop(name, None)
+            meta = {"ret": [ret.origVars, ret.origCls, ret.vars, ret.totalCount, ret.div], "stats": stats}
+            try:
+                save_result(self.result_cache, key, outputFile, meta, self.result_cache_link,
+                            self.result_cache_size*1024*1024)
+            except OSError as e:
+                print("WARNING: Could not write the result cache %s: %s" % (self.result_cache, e))
+        return ret
+
+    def transform_uncached(self, fname, outputFile):
+        with self.phase("parse"):
+            cnf = self.parse_file(fname)
+        try:
+            return self.transform_parsed(cnf, outputFile)
+        finally:
+            cnf.close()
+
+    # convert() of the CNF file fname, through the parse cache if there is
+    # one, which has the clause buffers ready
+    def convert_file(self, fname):
+        with self.phase("parse"):
+            cnf = self.parse_file(fname)
+        with self.phase("encode"):
+            lits, offsets = cnf.clause_buffers()
+            cnf.close()
+        return self.convert_parsed(cnf, lits, offsets)
 
-                # Model Counting Competition has these. I can't explain this without going on a rant
-                if var not in self.sampl_set:
-                    print(f"WARNING: Variable {var} has a weight but is not part of the sampling set. Skipping it!")
+    #  The code is straightforward chain formula implementation
+    #  lines can be a list of lines, an open text file or a binary stream, it
+    #  is only read once
+    def transform(self, lines, outputFile):
+        with self.phase("parse"):
+            cnf = self.parse(lines)
+        try:
+            return self.transform_parsed(cnf, outputFile)
+        finally:
+            cnf.close()
+
+    # the rest of transform(), after the parse
+    def transform_parsed(self, cnf, outputFile):
+        multiplier, chains = self.quantize_cnf(cnf)
+        if self.indexed:
+            return self.write_indexed(outputFile, cnf, chains)
+        with self.phase("encode"):
+            new_cnf, vars, num_cls, div = self.encode_chains(cnf, chains)
+        with self.phase("write"):
+            self.write_cnf(outputFile, cnf, new_cnf, vars, num_cls, multiplier)
+        return RetVal(cnf.vars, cnf.cls, vars, num_cls, div)
+
+    # the size of the output of transform_file(), see plan_parsed()
+    def plan_file(self, fname):
+        with self.phase("parse"):
+            cnf = self.parse_file(fname)
+        try:
+            return self.plan_parsed(cnf)
+        finally:
+            cnf.close()
+
+    # The exact size of what transform_parsed() would write, without encoding
+    # a chain: its clauses and literals are those of its template, and its
+    # bytes are counted by format_size(). The body is counted, not copied.
+    # Sizes are of the uncompressed output.
+    def plan_parsed(self, cnf):
+        multiplier, chains = self.quantize_cnf(cnf)
+        vars = cnf.vars
+        num_cls = cnf.cls
+        num_lits = cnf.num_lits
+        div = 0
+        size = 0
+        with self.phase("plan"):
+            self.plan_aux(vars, chains)
+            for var, bit_mult, bit_prec in chains:
+                if not self.add_chain_vars(bit_mult, bit_prec, vars):
+                    div += 1
+                    continue
+                chain = self.get_chain(bit_mult, bit_prec)
+                size += format_size(chain, var, vars, self.use_chain(chain))
+                self.count_lits(chain)
+                vars += bit_prec
+                num_cls += chain.num_cls
+                num_lits += chain.num_lits
+                div += bit_prec
+            vars = self.total_vars(vars)
+
+            size += len('p cnf %d %d \n' % (vars, num_cls)) + len('c p show 0\n')
+            size += sum(digits_total(lo, hi)+hi-lo+1 for lo, hi in self.sampl_set.to_ranges())
+            size += sum(length for fd, offset, length in cnf.segments)
+            size += len('c MUST MULTIPLY BY %s 0\n' % multiplier)
+        return {"origVars": cnf.vars, "origCls": cnf.cls, "addedVars": vars-cnf.vars,
+                "auxVars": self.aux_vars, "vars": vars, "clauses": num_cls, "literals": num_lits,
+                "bytes": size, "div": div, "multiplier": str(multiplier)}
+
+    # The output of transform_parsed(), laid out so that apply_delta() can
+    # rewrite the chain of a single weight in place. Every weighted variable
+    # in a clause gets precision chain variables, its chain uses the first
+    # bit_prec of them and the rest are free, which the div of precision per
+    # chain makes up for. So a new weight never renumbers any variable. Each
+    # chain is in a block padded with a comment line to the size of the
+    # largest chain at the precision, the header is padded to the largest
+    # clause count and the multiplier line comes last. Where the blocks are
+    # is written to the index, see index_name(). Only for the chain
+    # encoding at a uniform precision.
+    def write_indexed(self, outputFile, cnf, chains):
+        assert self.encoding == "chain" and self.error_bound is None, "--indexed needs the chain encoding and --prec"
+        prec = self.precision
+        vars = cnf.vars
+        num_cls = cnf.cls
+        div = 0
+        multiplier = fractions.Fraction(cnf.multiplier)
+        blocks = []
+        rows = []
+        at = 0
+        with self.phase("encode"):
+            for var, bit_mult, bit_prec in chains:
+                pos, neg = self.declared_weights.get(var), self.declared_weights.get(-var)
+                multiplier *= fractions.Fraction(sum(self.weight_pair(pos, neg)))
+                pos, neg = (None if val is None else str(val) for val in (pos, neg))
+                if not cnf.occurs_in_clause(var):
+                    # folded, see quantize_cnf()
+                    div += 1
+                    rows.append((var, pos, neg, None, None, None, None))
                     continue
-                if w == decimal.Decimal("0"):
-                    print(f"ERROR: Literal {lit} has a weight of 0, which means the CNF has not been preprocessed by Arjun. Exiting.")
+                if bit_prec == 0:
+                    print("ERROR: the formula was not preprocessed by Arjun")
                     exit(-1)
 
-                w[lit] = val
-
-        mult, w2 = self.clean_up_weights(w)
-        multiplier *= mult
-
-        for lit,val in w2.items():
-            if lit < 0:
-                # they now add up to 1, so we can skip the negative literals
+                chain = self.get_chain(bit_mult, bit_prec)
+                text = chain.format(var, vars)
+                size = self.block_size(var, vars, len(text))
+                blocks.append(fill_block(text, size))
+                rows.append((var, pos, neg, vars, at, size, chain.num_cls))
+                at += size
+                vars += prec
+                num_cls += chain.num_cls
+                div += prec
+            self.sampl_set.add_range(cnf.vars+1, vars)
+
+        with self.phase("write"):
+            cnf.detach_from(outputFile)
+            header = 'p cnf %d %d ' % (vars, num_cls)
+            width = len('p cnf %d %d ' % (vars, cnf.cls+len(blocks)*(prec+1)))
+            with open(outputFile, 'wb') as f:
+                f.write((header.ljust(width) + '\n').encode())
+                f.write(b'c p show ')
+                for part in self.sampl_set.format():
+                    f.write(part)
+                f.write(b"0\n")
+                cnf.copy_body(f)
+                start = f.tell()
+                f.write(''.join(blocks).encode())
+                end = f.tell()
+                f.write(('c MUST MULTIPLY BY %s 0\n' % exact_decimal(multiplier)).encode())
+                self.counters["bytesWritten"] = f.tell()
+
+            rows = [row if row[4] is None else row[:4] + (start+row[4],) + row[5:] for row in rows]
+            st = os.stat(outputFile)
+            meta = {"version": INDEX_VERSION, "precision": prec, "headerWidth": width, "vars": vars,
+                    "clauses": num_cls, "blocksEnd": end, "multiplier": str(multiplier),
+                    "size": st.st_size, "mtimeNs": st.st_mtime_ns}
+            write_index(index_name(outputFile), meta, rows)
+        self.multiplier = decimal.Decimal(multiplier.numerator)/decimal.Decimal(multiplier.denominator)
+        return RetVal(cnf.vars, cnf.cls, vars, num_cls, div)
+
+    # the weights of var and -var, from those declared for them, None if not
+    # declared, like clean_up_weights() fills them in
+    def weight_pair(self, pos, neg):
+        one = decimal.Decimal("1")
+        return (pos if pos is not None else one-neg), (neg if neg is not None else one-pos)
+
+    # The size of the block of a chain of size bytes for var, with chain
+    # variables after base: room for the largest chain at the precision,
+    # which has its low half of bits set
+    def block_size(self, var, base, size):
+        if self.largest_chain is None:
+            self.largest_chain = ChainTemplate(2**((self.precision+1)//2)-1, self.precision)
+        return max(size, format_size(self.largest_chain, var, base, 0))
+
+    # The changed weights of apply_delta(): "c p weight" or "w" lines, like
+    # those of a CNF, and comments
+    def parse_changes(self, lines):
+        changes = {}
+        for num, line in enumerate(lines, 1):
+            line = line.strip()
+            if len(line) == 0 or (line[0] == 'c' and line[:10] != 'c p weight'):
                 continue
-            var = abs(lit)
-            bit_mult, bit_prec = self.quantize_weight(val)
+            if line[:2] == 'w ': start = 2
+            elif line[:10] == 'c p weight': start = 10
+            else:
+                print(f"ERROR: Line {num} of the changes is not a 'c p weight LIT WEIGHT 0' line: {line}")
+                exit(-1)
+            fields = line[start:].split()
+            lit = int(fields[0])
+            if lit == 0:
+                print("ERROR: Literal 0 has a weight, but literal 0 is not allowed in CNF")
+                exit(-1)
+            if lit in changes:
+                print(f"ERROR: Lit {lit} has TWO weights declared")
+                print(f"ERROR: The problem is on line {num} of the changes")
+                exit(-1)
+            changes[lit] = self.parse_weight(fields[1])
+        return changes
+
+    # Changes the weights of the --indexed output outputFile, see
+    # write_indexed(), to those of the "c p weight" lines in lines. Only the
+    # chains of the changed weights, the header and the multiplier line are
+    # written, so the time this takes does not depend on the size of the
+    # output. A chain that no longer fits its block is moved to a new block
+    # after the others. The output then counts what a fresh --indexed
+    # conversion of the changed CNF counts. Every change is checked before
+    # anything is written.
+    def apply_delta(self, outputFile, lines):
+        db, meta = open_index(outputFile)
+        try:
+            return self.delta_indexed(outputFile, db, meta, self.parse_changes(lines))
+        finally:
+            db.close()
+
+    def delta_indexed(self, outputFile, db, meta, changes):
+        self.precision = meta["precision"]
+        multiplier = fractions.Fraction(meta["multiplier"])
+        num_cls = meta["clauses"]
+        blocks = []
+        folded = 0
+        with self.phase("quantize"):
+            for var in sorted(set(abs(lit) for lit in changes)):
+                row = db.execute("SELECT pos, neg, base, at, size, clauses FROM weights WHERE var = ?", (var,)).fetchone()
+                if row is None:
+                    print(f"ERROR: Variable {var} has no weight in {outputFile}, only the weights it was converted with can be changed")
+                    print("ERROR: Convert the changed CNF again to give it a weight")
+                    exit(-1)
+                pos, neg, base, at, size, clauses = row
+                old = self.weight_pair(*(None if val is None else decimal.Decimal(val) for val in (pos, neg)))
+                pos, neg = (changes.get(lit, None if val is None else decimal.Decimal(val))
+                            for lit, val in ((var, pos), (-var, neg)))
+                new = self.weight_pair(pos, neg)
+                self.check_all_weights_non_zero_or_negativer({var: new[0], -var: new[1]})
+                multiplier *= fractions.Fraction(sum(new))/fractions.Fraction(sum(old))
+                if base is None:
+                    folded += 1
+                    blocks.append((var, pos, neg, None))
+                    continue
 
-            if self.verbose:
-                new_weight = decimal.Decimal(bit_mult)/decimal.Decimal(2**bit_prec)
-                print(f"var: {var} orig-weight: {val} bit_mult: {bit_mult} bit_prec: {bit_prec} weight as represented in CNF: {new_weight}")
+                total = sum(new)
+                weight = new[0] if total == decimal.Decimal("1") else new[0]*(decimal.Decimal("1")/total)
+                bit_mult, bit_prec = self.quantize_weight(weight)
+                if bit_prec == 0:
+                    print(f"ERROR: The new weight of variable {var} rounds to {bit_mult} at precision {self.precision}, which means the CNF has not been preprocessed by Arjun")
+                    exit(-1)
+                chain = self.get_chain(bit_mult, bit_prec)
+                num_cls += chain.num_cls-clauses
+                blocks.append((var, pos, neg, (chain.format(var, base), base, at, size)))
+
+        relocated = 0
+        end = meta["blocksEnd"]
+        with self.phase("write"):
+            with open(outputFile, 'r+b') as f:
+                moved = []
+                for var, pos, neg, block in blocks:
+                    if block is None:
+                        continue
+                    text, base, at, size = block
+                    if len(text) > size:
+                        # the old block becomes padding, the chain goes last
+                        f.seek(at)
+                        f.write(padding(size).encode())
+                        size = self.block_size(var, base, len(text))
+                        at = end
+                        end += size
+                        moved.append(fill_block(text, size))
+                        relocated += 1
+                    else:
+                        f.seek(at)
+                        f.write(fill_block(text, size).encode())
+                    db.execute("UPDATE weights SET at = ?, size = ? WHERE var = ?", (at, size, var))
+
+                header = 'p cnf %d %d ' % (meta["vars"], num_cls)
+                f.seek(0)
+                f.write((header.ljust(meta["headerWidth"]) + '\n').encode())
+                f.seek(meta["blocksEnd"])
+                f.truncate()
+                f.write(''.join(moved).encode())
+                f.write(('c MUST MULTIPLY BY %s 0\n' % exact_decimal(multiplier)).encode())
+
+            st = os.stat(outputFile)
+            with db:
+                for var, pos, neg, block in blocks:
+                    clauses = None if block is None else block[0].count('\n')
+                    db.execute("UPDATE weights SET pos = ?, neg = ?, clauses = ? WHERE var = ?",
+                               (None if pos is None else str(pos), None if neg is None else str(neg), clauses, var))
+                for key, val in (("clauses", num_cls), ("blocksEnd", end), ("multiplier", str(multiplier)),
+                                 ("size", st.st_size), ("mtimeNs", st.st_mtime_ns)):
+                    db.execute("UPDATE meta SET value = ? WHERE key = ?", (val, key))
+        self.multiplier = decimal.Decimal(multiplier.numerator)/decimal.Decimal(multiplier.denominator)
+        return {"changed": len(blocks)-folded, "folded": folded, "relocated": relocated,
+                "clauses": num_cls, "multiplier": exact_decimal(multiplier)}
+
+    # transform() of the CNF file fname into shards CNFs, see split_parsed()
+    def split_file(self, fname, outputFile, shards):
+        with self.phase("parse"):
+            cnf = self.parse_file(fname)
+        try:
+            return self.split_parsed(cnf, outputFile, shards)
+        finally:
+            cnf.close()
+
+    # Writes shards, a power of 2, CNFs that each add a cube of unit clauses
+    # on the same split variables, see split_vars(), so that their projected
+    # counts add up to that of the whole output. The manifest next to them
+    # lists the cubes and how to combine the counts.
+    def split_parsed(self, cnf, outputFile, shards):
+        multiplier, chains = self.quantize_cnf(cnf)
+        with self.phase("encode"):
+            new_cnf, vars, num_cls, div = self.encode_chains(cnf, chains)
+            d = shards.bit_length()-1
+            split = self.split_vars(cnf, chains, d)
+
+        self.manifest = {"version": 1, "splitVars": [v for v, _ in split], "shards": [],
+                         "origVars": cnf.vars, "vars": vars, "clauses": num_cls+d, "div": div,
+                         "multiplier": str(multiplier),
+                         "weightedCount": "(sum of the projected counts of the shards) / 2**div * multiplier"}
+        written = 0
+        with self.phase("write"):
+            for i in range(shards):
+                cube = [v if (i >> j) & 1 else -v for j, (v, _) in enumerate(split)]
+                lo = hi = fractions.Fraction(1)
+                for j, (v, ranges) in enumerate(split):
+                    lo *= ranges[(i >> j) & 1][0]
+                    hi *= ranges[(i >> j) & 1][1]
+                name = shard_name(outputFile, i)
+                self.write_cnf(name, cnf, new_cnf + ["".join("%d 0\n" % l for l in cube)],
+                               vars, num_cls+d, multiplier)
+                written += self.counters.get("bytesWritten", 0)
+                self.manifest["shards"].append({"file": os.path.basename(name), "cube": cube,
+                                                "fraction": [float(lo), float(hi)]})
+            with open(shard_name(outputFile, None), 'w') as f:
+                json.dump(self.manifest, f, indent=1)
+        self.counters["bytesWritten"] = written
+        return RetVal(cnf.vars, cnf.cls, vars, num_cls+d, div)
+
+    # The d variables of the cubes of --split, each with the range of the
+    # fraction of the count that its false and its true value get. Bit 0 of a
+    # chain splits both the assignments of its chain variables that make
+    # the weighted variable true and the others in half, to within one, so
+    # it splits every model about evenly. The chains whose weights are
+    # furthest from 0 and 1 come first, then show variables in no clause,
+    # which split exactly, then any other show variables.
+    def split_vars(self, cnf, chains, d):
+        cands = []
+        vars = cnf.vars
+        for var, bit_mult, bit_prec in chains:
+            if (bit_mult, bit_prec) == (1, 1):
+                continue
+            vars += bit_prec
+            chain = self.chain_cache[(self.encoding, bit_mult, bit_prec)]
+            cands.append((min(bit_mult, 2**bit_prec-bit_mult), vars, chain))
+        cands.sort(key=lambda c: -c[0])
+
+        split = []
+        for _, var, chain in cands[:d]:
+            split.append((var, [sorted(split_ratios(chain, b)) for b in (0, 1)]))
+        half = fractions.Fraction(1, 2)
+        for var in self.sampl_set:
+            if len(split) == d:
+                break
+            if var <= cnf.vars and not cnf.occurs_in_clause(var):
+                split.append((var, [[half, half], [half, half]]))
+        if len(split) < d:
+            used = set(v for v, _ in split)
+            others = [var for var in self.sampl_set if var not in used][:d-len(split)]
+            if len(split)+len(others) < d:
+                print("ERROR: --split %d needs %d variables in the sampling set to split on, but it only has %d" % (
+                    2**d, d, len(split)+len(others)))
+                exit(-1)
+            print("WARNING: Only %d chains and free variables to split on, the shards may be uneven" % len(split))
+            split += [(var, [[0, 1], [0, 1]]) for var in others]
+        return split
+
+    # the chain formulas of all weighted variables, as text
+    def encode_chains(self, cnf, chains):
+        vars = cnf.vars
+        num_cls = cnf.cls
+        div = 0
 
+        new_cnf = []
+        self.plan_aux(vars, chains)
+        for var, bit_mult, bit_prec in chains:
             # we have to encode to CNF the translation
             lines, vars, num_cls, div = self.encodeCNF(var, bit_mult, bit_prec, vars, num_cls, div)
-            new_cnf += lines
-
-        with open(outputFile, 'w') as f:
-            f.write('p cnf '+str(vars)+' '+str(num_cls)+' \n')
-            f.write('c p show ')
-            for k in self.sampl_set:
-                f.write("%d " % k)
-            f.write("0\n")
-
-            f.write(orig_cnf_lines)
-            f.write(new_cnf)
-            f.write('c MUST MULTIPLY BY %s 0\n' % multiplier)
+            new_cnf.append(lines)
+        return new_cnf, self.total_vars(vars), num_cls, div
+
+    # outputFile is a file name or an open binary file, e.g. a pipe
+    def write_cnf(self, outputFile, cnf, new_cnf, vars, num_cls, multiplier):
+        if isinstance(outputFile, str):
+            cnf.detach_from(outputFile)
+            # an output hard linked into a --result-cache is replaced, not
+            # written into
+            try:
+                if os.stat(outputFile).st_nlink > 1:
+                    os.unlink(outputFile)
+            except OSError:
+                pass
+            out = open_cnf(outputFile, 'wb')
+        else:
+            out = contextlib.nullcontext(outputFile)
+        with out as f:
+            f.write(('p cnf '+str(vars)+' '+str(num_cls)+' \n').encode())
+            f.write(b'c p show ')
+            for part in self.sampl_set.format():
+                f.write(part)
+            f.write(b"0\n")
+
+            cnf.copy_body(f)
+            f.write(''.join(new_cnf).encode())
+            f.write(('c MUST MULTIPLY BY %s 0\n' % multiplier).encode())
+            # uncompressed, also for compressed outputs, not known for pipes
+            try:
+                self.counters["bytesWritten"] = f.tell()
+            except OSError:
+                pass
+
+    # Like transform(), but returns the converted CNF as flat integer buffers
+    # instead of writing it out, e.g. to hand it to a solver in-process.
+    def convert(self, lines):
+        with self.phase("parse"):
+            cnf = self.parse(lines)
+        with self.phase("encode"):
+            lits, offsets = cnf.clause_buffers()
+            cnf.close()
+        return self.convert_parsed(cnf, lits, offsets)
+
+    # the rest of convert(), the chains are appended to lits and offsets,
+    # which come after the clauses in base, a (lits, offsets), if given
+    def convert_parsed(self, cnf, lits, offsets, base=(None, None)):
+        multiplier, chains = self.quantize_cnf(cnf)
+        vars = cnf.vars
+        num_cls = cnf.cls
+        div = 0
 
-        return RetVal(origVars, origCls, vars, num_cls, div)
+        with self.phase("encode"):
+            self.plan_aux(vars, chains)
+            for var, bit_mult, bit_prec in chains:
+                vars, num_cls, div = self.encode_buffers(var, bit_mult, bit_prec, vars, num_cls, div, lits, offsets)
+            vars = self.total_vars(vars)
+
+        return ConvertedCNF(cnf.vars, cnf.cls, vars, num_cls, div, lits, offsets, self.sampl_set, multiplier, *base)
+
+    # Like transform(), but streams the converted CNF into the stdin of a
+    # model counter, cmd, instead of writing it out. The counter is started
+    # first, so it starts up while we parse, and counts while we write.
+    # Returns a CountedCNF with the exact weighted count.
+    def count(self, lines, cmd):
+        counter = CounterProcess(cmd)
+        try:
+            ret = self.transform(lines, counter.stdin())
+        except BrokenPipeError:
+            # it stopped reading, what it printed tells why
+            ret = None
+        except BaseException:
+            counter.kill()
+            raise
+
+        with self.phase("count"):
+            code, output = counter.finish()
+        count = parse_count(output)
+        if ret is None or count is None:
+            print("ERROR: The counter %s exited with code %d %s" % (
+                counter.argv[0], code,
+                "before reading the whole CNF" if ret is None else "without printing an 's mc' line"))
+            for line in output.splitlines()[-10:]:
+                print("ERROR: counter: %s" % line)
+            exit(-1)
+        return CountedCNF(ret, self.multiplier, count)
+
+    # Normalizes and quantizes the weights of the CNF. Returns the multiplier
+    # and the (var, bit_mult, bit_prec) of every variable that needs a chain.
+    def quantize_cnf(self, cnf):
+        with self.phase("weights"):
+            w = self.get_weights(cnf)
+            if self.indexed:
+                self.declared_weights = dict(w)
+        with self.phase("normalize"):
+            mult, w2 = self.clean_up_weights(w)
+        multiplier = cnf.multiplier * mult
+        self.multiplier = multiplier
+
+        # they now add up to 1, so we can skip the negative literals
+        pos = [(lit, val) for lit, val in w2.items() if lit > 0]
+        # A weighted variable in no clause only adds a factor of
+        # w(var)+w(-var) to the count, which is in the multiplier already.
+        # It needs no chain: it is left free, like a weight of 0.5.
+        folded = set(lit for lit, val in pos if not cnf.occurs_in_clause(lit))
+        self.counters["foldedVars"] = len(folded)
+        vals = [val for lit, val in pos if lit not in folded]
+        with self.phase("quantize"):
+            if self.error_bound is None:
+                quantized = self.quantize_weights(vals)
+            else:
+                quantized = self.quantize_weights(vals, self.adaptive_precisions(vals))
+                self.achieved_error = self.quantization_error(vals, quantized)
+                uniform = self.quantize_weights(vals)
+                self.uniform_added_vars = sum(bit_prec for bit_mult, bit_prec in uniform if (bit_mult, bit_prec) != (1, 1))
+                self.uniform_error = self.quantization_error(vals, uniform)
+
+        chains = []
+        quantized = iter(quantized)
+        for var, val in pos:
+            if var in folded:
+                if self.verbose:
+                    print(f"var: {var} orig-weight: {val} is in no clause, folded into the multiplier")
+                chains.append((var, 1, 1))
+                continue
+            bit_mult, bit_prec = next(quantized)
+            if self.verbose:
+                new_weight = decimal.Decimal(bit_mult)/decimal.Decimal(2**bit_prec)
+                print(f"var: {var} orig-weight: {val} bit_mult: {bit_mult} bit_prec: {bit_prec} weight as represented in CNF: {new_weight}")
+            chains.append((var, bit_mult, bit_prec))
+        return multiplier, chains
 
     def parse_weight(self, dat):
         if "/" in dat:
@@ -394,6 +2574,533 @@ class Converter:
         return val
 
 
+# A CNF that is parsed once and then converted for many weight maps and
+# precisions, e.g. in a parameter learning loop. Each conversion only redoes
+# the weight clean up, quantization and chain encoding; the original clauses
+# are copied as they are, not parsed again. Weight maps go from literal to
+# weight, like the "c p weight" lines, and replace the weights of the CNF.
+class PreparedCNF:
+    def __init__(self, lines, verbose=False, parse_jobs=1):
+        self.verbose = verbose
+        c = Converter(precision=None, verbose=verbose, parse_jobs=parse_jobs)
+        self.cnf = c.parse(lines)
+        self.sampl_set = c.sampl_set
+        # the chain formulas do not depend on the variables, so all
+        # conversions share them
+        self.chain_cache = {}
+        # flat clause buffers, only built for convert()
+        self.lits = None
+        self.offsets = None
+
+    def close(self):
+        self.cnf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # the CNF's own weights, as read
+    def weights(self):
+        return dict(self.cnf.weights)
+
+    def converter(self, precision, error_bound, encoding):
+        c = Converter(precision, self.verbose, error_bound, encoding=encoding)
+        c.sampl_set = self.sampl_set.copy()
+        c.chain_cache = self.chain_cache
+        return c
+
+    def with_weights(self, c, weights):
+        if weights is None:
+            return self.cnf
+        cnf = copy.copy(self.cnf)
+        cnf.weights = {}
+        for lit, val in weights.items():
+            if isinstance(val, str):
+                val = c.parse_weight(val)
+            elif isinstance(val, fractions.Fraction):
+                val = decimal.Decimal(val.numerator) / decimal.Decimal(val.denominator)
+            else:
+                val = decimal.Decimal(val)
+            cnf.weights[lit] = val
+        return cnf
+
+    # Converter.transform() with the given weights, None for the CNF's own
+    def transform(self, outputFile, weights=None, precision=7, error_bound=None, encoding="chain"):
+        # the copy with_weights() makes shares the body, so writing over the
+        # input must detach the CNF itself
+        if isinstance(outputFile, str):
+            self.cnf.detach_from(outputFile)
+        c = self.converter(precision, error_bound, encoding)
+        return c.transform_parsed(self.with_weights(c, weights), outputFile)
+
+    # Converter.convert() with the given weights, None for the CNF's own
+    def convert(self, weights=None, precision=7, error_bound=None, encoding="chain"):
+        if self.lits is None:
+            self.lits, self.offsets = self.cnf.clause_buffers()
+        c = self.converter(precision, error_bound, encoding)
+        # the clauses are shared, not copied, so that a conversion takes
+        # the same time for any number of them
+        return c.convert_parsed(self.with_weights(c, weights), array.array('i'), array.array('q', [0]),
+                                (self.lits, self.offsets))
+
+
+# A model counter that reads a CNF on its stdin. Its output is collected on a
+# thread, so that a counter that prints while it reads cannot block us. "{}"
+# in an argument is replaced by /dev/stdin, for counters that want a file.
+class CounterProcess:
+    def __init__(self, cmd):
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        self.argv = [arg.replace("{}", "/dev/stdin") for arg in cmd]
+        if not self.argv:
+            print("ERROR: The counter command is empty")
+            exit(-1)
+        try:
+            self.proc = subprocess.Popen(self.argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError as e:
+            print("ERROR: Could not start the counter %s: %s" % (self.argv[0], e))
+            exit(-1)
+        self.output = []
+        self.reader = threading.Thread(target=self.read_output, daemon=True)
+        self.reader.start()
+
+    def read_output(self):
+        self.output.append(self.proc.stdout.read())
+
+    def stdin(self):
+        return self.proc.stdin
+
+    # closes its stdin and waits for it, returns its exit code and output
+    def finish(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        code = self.proc.wait()
+        self.reader.join()
+        self.proc.stdout.close()
+        return code, self.output[0].decode(errors="replace")
+
+    def kill(self):
+        self.proc.kill()
+        self.finish()
+
+
+# The count in the output of a model counter: the "s mc N" line, or the
+# "c s exact|approx ... N" line of the model counting competition format,
+# 0 if it only says UNSATISFIABLE. None if there is no count at all.
+def parse_count(output):
+    count = None
+    unsat = False
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[:2] == ["s", "mc"]:
+            return parse_count_value(parts[2])
+        if len(parts) >= 4 and parts[:2] == ["c", "s"] and parts[2] in ("exact", "approx"):
+            count = parse_count_value(parts[-1])
+        if parts == ["s", "UNSATISFIABLE"]:
+            unsat = True
+    if count is None and unsat:
+        return 0
+    return count
+
+
+# Counts and weighted counts easily have more digits than Python converts
+# to and from strings by default.
+@contextlib.contextmanager
+def long_int_strings():
+    if not hasattr(sys, "set_int_max_str_digits"):
+        yield
+        return
+    old = sys.get_int_max_str_digits()
+    sys.set_int_max_str_digits(0)
+    try:
+        yield
+    finally:
+        sys.set_int_max_str_digits(old)
+
+
+# an integer stays an integer, anything else, e.g. 1.5e30, is read exactly
+def parse_count_value(dat):
+    try:
+        with long_int_strings():
+            if dat.isdigit():
+                return int(dat)
+            return fractions.Fraction(dat)
+    except ValueError:
+        print("ERROR: Could not read the count of the counter: %s" % dat)
+        exit(-1)
+
+
+# All digits of a number whose denominator only has the prime factors 2 and
+# 5, as weighted counts do. Anything else is written as a fraction.
+def exact_decimal(x):
+    x = fractions.Fraction(x)
+    den = x.denominator
+    twos = fives = 0
+    while den % 2 == 0:
+        den //= 2
+        twos += 1
+    while den % 5 == 0:
+        den //= 5
+        fives += 1
+    with long_int_strings():
+        if den != 1:
+            return str(x)
+        digits = max(twos, fives)
+        n = abs(x.numerator) * (10**digits // x.denominator)
+        s = str(n).rjust(digits+1, '0')
+    sign = "-" if x < 0 else ""
+    if digits == 0:
+        return sign+s
+    return sign+s[:-digits]+"."+s[-digits:]
+
+
+def init_worker():
+    decimal.getcontext().prec = 100
+
+
+# the first line end at or after pos, or size
+def line_end(f, pos, size):
+    if pos >= size:
+        return size
+    f.seek(pos)
+    f.readline()
+    return min(f.tell(), size)
+
+
+# Scans bytes start..end of the CNF fname in a worker of
+# Converter.parse_parallel(). vars and cls are from the header, which is
+# before start. Never exits, errors are returned with the line they are on,
+# counted from start.
+def scan_chunk(job):
+    fname, start, end, vars, cls = job
+    c = Converter(precision=None)
+    cnf = ParsedCNF()
+    cnf.set_header(vars, cls)
+    cnf.weight_lines = {}
+    error = None
+    out = io.StringIO()
+    with open(fname, 'rb') as f:
+        # segments in the file are marked with src -1, the fd of the parent
+        # takes its place when merging
+        cnf.src = -1
+        f.seek(start)
+        try:
+            with contextlib.redirect_stdout(out):
+                c.parse_range(f, cnf, start, end)
+        except SystemExit:
+            error = [l for l in out.getvalue().splitlines() if l.startswith("ERROR: ")]
+    cnf.body.seek(0)
+    body = cnf.body.read()
+    cnf.body.close()
+    return {"maxvar": cnf.maxvar, "num_clauses": cnf.num_clauses, "num_lits": cnf.num_lits, "lines": cnf.num_lines,
+            "headers": cnf.headers, "weights": cnf.weights, "weight_lines": cnf.weight_lines,
+            "multiplier": cnf.multiplier, "multiplier_line": cnf.multiplier_line,
+            "show": c.sampl_set.vars, "found_sampl_set": cnf.found_sampl_set,
+            "occurs": cnf.packed_occurrences(),
+            "segments": cnf.segments, "body": body, "error": error}
+
+
+# converts one file, never exits: errors are returned in the result so that
+# one bad instance does not stop a whole batch
+def convert_file(job):
+    inputFile, outputFile, options = job
+    res = {"file": inputFile, "status": "ok", "origVars": "", "addedVars": "",
+           "origCls": "", "vars": "", "totalCount": "",
+           "div": "", "time": 0.0, "error": "", "stats": None, "output": ""}
+    startTime = time.time()
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            c = Converter(**options)
+            ret = c.transform_file(inputFile, outputFile)
+        res["origVars"] = ret.origVars
+        res["addedVars"] = ret.vars-ret.origVars
+        res["origCls"] = ret.origCls
+        res["vars"] = ret.vars
+        res["totalCount"] = ret.totalCount
+        res["div"] = ret.div
+        res["stats"] = c.get_stats(ret)
+    except SystemExit:
+        errors = [l[7:] for l in out.getvalue().splitlines() if l.startswith("ERROR: ")]
+        res["status"] = "error"
+        res["error"] = " ".join(errors) if errors else "conversion failed"
+    except Exception as e:
+        res["status"] = "error"
+        res["error"] = "%s: %s" % (type(e).__name__, e)
+    res["time"] = time.time()-startTime
+    # what the conversion printed, for the client of --serve
+    res["output"] = out.getvalue()
+    return res
+
+
+# the columns of the --plan table, see Converter.plan_parsed()
+PLAN_COLUMNS = ["file", "status", "origVars", "origCls", "addedVars", "auxVars", "vars", "clauses",
+                "literals", "bytes", "div", "time", "error"]
+
+
+# plans one file like convert_file() converts it
+def plan_file(job):
+    inputFile, options = job
+    res = dict.fromkeys(PLAN_COLUMNS, "")
+    res.update({"file": inputFile, "status": "ok"})
+    startTime = time.time()
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            c = Converter(**options)
+            res.update(c.plan_file(inputFile))
+    except SystemExit:
+        errors = [l[7:] for l in out.getvalue().splitlines() if l.startswith("ERROR: ")]
+        res["status"] = "error"
+        res["error"] = " ".join(errors) if errors else "planning failed"
+    except Exception as e:
+        res["status"] = "error"
+        res["error"] = "%s: %s" % (type(e).__name__, e)
+    res["time"] = "%0.3f" % (time.time()-startTime)
+    return res
+
+
+def file_size(fname):
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return 0
+
+
+# a source is a directory (all CNFs in it, compressed or not), a glob, a
+# single CNF or a manifest file listing one input per line
+def find_inputs(sources):
+    files = []
+    for src in sources:
+        if os.path.isdir(src):
+            files += sorted(f for f in glob.glob(os.path.join(src, "*")) if is_cnf_name(f))
+        elif any(ch in src for ch in "*?["):
+            files += sorted(glob.glob(src))
+        elif is_cnf_name(src):
+            files.append(src)
+        else:
+            base = os.path.dirname(src)
+            with open(src, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if len(line) == 0 or line[0] == '#':
+                        continue
+                    files.append(os.path.join(base, line))
+    return files
+
+
+def write_stats(stats, fname):
+    if fname == '-':
+        json.dump(stats, sys.stderr, indent=1)
+        sys.stderr.write("\n")
+    else:
+        with open(fname, 'w') as f:
+            json.dump(stats, f, indent=1)
+
+
+# options are the keyword arguments of Converter. With stats, the stats of
+# every converted file are written there as a JSON list.
+def run_batch(sources, outdir, options, jobs, summary, stats=None):
+    files = find_inputs(sources)
+    if len(files) == 0:
+        print("ERROR: No input CNFs found in %s" % " ".join(sources))
+        return -1
+
+    outputs = {}
+    for fname in files:
+        out = os.path.join(outdir, os.path.basename(fname))
+        if out in outputs:
+            print("ERROR: Both %s and %s would be written to %s" % (outputs[out], fname, out))
+            return -1
+        outputs[out] = fname
+    os.makedirs(outdir, exist_ok=True)
+
+    # largest first, so that a big instance does not start last and keep a
+    # single worker busy at the end
+    todo = [(fname, os.path.join(outdir, os.path.basename(fname)), options) for fname in files]
+    todo.sort(key=lambda job: -file_size(job[0]))
+    results = {}
+    with multiprocessing.Pool(jobs, initializer=init_worker) as pool:
+        for res in pool.imap_unordered(convert_file, todo):
+            results[res["file"]] = res
+            if res["status"] != "ok":
+                print("FAILED: %s -- %s" % (res["file"], res["error"]))
+
+    cols = ["file", "status", "origVars", "addedVars", "div", "time", "error"]
+    with open(summary, 'w') as f:
+        f.write("\t".join(cols) + "\n")
+        for fname in files:
+            res = results[fname]
+            res["time"] = "%0.3f" % res["time"]
+            f.write("\t".join(str(res[col]) for col in cols) + "\n")
+    if stats is not None:
+        write_stats([dict(results[fname]["stats"] or {}, file=fname, status=results[fname]["status"])
+                     for fname in files], stats)
+
+    failed = sum(1 for res in results.values() if res["status"] != "ok")
+    print("Converted %d of %d files, %d failed. Summary written to %s" % (
+        len(files)-failed, len(files), failed, summary))
+    return 0 if failed == 0 else -1
+
+
+# Writes the exact output size of every input of sources, found like
+# run_batch() finds them, as a table to summary, or to stdout if it is -.
+# Nothing is converted.
+def run_plan(sources, options, jobs, summary):
+    files = find_inputs(sources)
+    if len(files) == 0:
+        print("ERROR: No input CNFs found in %s" % " ".join(sources))
+        return -1
+
+    todo = [(fname, options) for fname in files]
+    todo.sort(key=lambda job: -file_size(job[0]))
+    results = {}
+    with multiprocessing.Pool(jobs, initializer=init_worker) as pool:
+        for res in pool.imap_unordered(plan_file, todo):
+            results[res["file"]] = res
+
+    out = sys.stdout if summary == '-' else open(summary, 'w')
+    try:
+        out.write("\t".join(PLAN_COLUMNS) + "\n")
+        for fname in files:
+            out.write("\t".join(str(results[fname][col]) for col in PLAN_COLUMNS) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    failed = sum(1 for res in results.values() if res["status"] != "ok")
+    if summary != '-':
+        print("Planned %d of %d files, %d failed. Plan written to %s" % (
+            len(files)-failed, len(files), failed, summary))
+    return 0 if failed == 0 else -1
+
+
+# the options of a --serve job, passed on to Converter
+SERVE_OPTIONS = {"precision": (int,), "error_bound": (int, float, type(None)), "encoding": (str,), "verbose": (bool, type(None)),
+                 "parse_cache": (str, type(None)), "result_cache": (str, type(None)), "result_cache_size": (int,),
+                 "result_cache_link": (bool, type(None))}
+
+# longest request line --serve reads
+MAX_REQUEST = 64*1024
+
+
+# A --serve request is one JSON line: {"input": ..., "output": ...,
+# "options": {...}}, with absolute paths. The answer is convert_file()'s
+# result, also one JSON line. {"stop": true} stops the server.
+def server_job(req):
+    if not isinstance(req, dict):
+        return None, "the request is not a JSON object"
+    for key in ("input", "output"):
+        if not isinstance(req.get(key), str) or not os.path.isabs(req[key]):
+            return None, "the request needs an absolute %s path" % key
+    options = req.get("options", {})
+    if not isinstance(options, dict):
+        return None, "the options are not a JSON object"
+    for key, val in options.items():
+        # bool is an int subclass, but true is no precision
+        if key not in SERVE_OPTIONS or not isinstance(val, SERVE_OPTIONS[key]) or \
+                (isinstance(val, bool) and bool not in SERVE_OPTIONS[key]):
+            return None, "bad option %s: %s" % (key, json.dumps(val))
+    if options.get("encoding", "chain") not in ENCODINGS:
+        return None, "unknown encoding %s" % options["encoding"]
+    if options.get("error_bound") is not None and options["error_bound"] <= 0:
+        return None, "error_bound must be positive"
+    if options.get("precision", 7) < 2:
+        return None, "precision must be at least 2"
+    if options.get("result_cache_size", 0) < 0:
+        return None, "result_cache_size must not be negative"
+    return (req["input"], req["output"], options), None
+
+
+def handle_request(conn, pool, slots, stop):
+    try:
+        with conn, conn.makefile('rb') as r:
+            try:
+                req = json.loads(r.readline(MAX_REQUEST))
+            except ValueError:
+                req = None
+            if isinstance(req, dict) and req.get("stop"):
+                stop.set()
+                res = {"status": "stopped"}
+            else:
+                job, error = server_job(req)
+                if job is None:
+                    res = {"status": "error", "error": "Bad request: %s" % error}
+                else:
+                    res = pool.apply(convert_file, (job,))
+            conn.sendall((json.dumps(res) + "\n").encode())
+    except OSError:
+        # the client went away
+        pass
+    finally:
+        slots.release()
+
+
+# Converts the jobs sent to a Unix socket at path on a pool of jobs warm
+# worker processes, so a conversion does not pay for starting Python. At most
+# queue jobs are taken at a time; then the server stops accepting and
+# clients wait in the socket's backlog, until even connect() waits.
+def serve(path, jobs, queue):
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            print("ERROR: %s exists and is not a socket" % path)
+            return -1
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+                print("ERROR: A server is already running on %s" % path)
+                return -1
+            except OSError:
+                # left over from a server that is gone
+                os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # whoever can connect can have files read and written as us, so the
+    # socket is created accessible by its owner only
+    umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(queue)
+    # accept() wakes up now and then to see if we were stopped
+    sock.settimeout(0.5)
+    slots = threading.Semaphore(queue)
+    stop = threading.Event()
+    pool = multiprocessing.Pool(jobs, initializer=init_worker)
+    # after the workers are forked, so that they keep the default
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    print("Serving on %s with %d workers" % (path, jobs), flush=True)
+    try:
+        while not stop.is_set():
+            if not slots.acquire(timeout=0.5):
+                continue
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                slots.release()
+                continue
+            conn.settimeout(None)
+            threading.Thread(target=handle_request, args=(conn, pool, slots, stop), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.unlink(path)
+        # the jobs that were taken are finished, not killed
+        for _ in range(queue):
+            slots.acquire()
+        pool.close()
+        pool.join()
+    print("Server on %s stopped" % path)
+    return 0
+
+
 # main function
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -401,26 +3108,238 @@ if __name__ == '__main__':
         "--verbose", help="Verbose debug printing", action="store_const",
         const=True)
     parser.add_argument("--prec", help="Precision (value of m)", type=int, default=7)
-    parser.add_argument("inputFile", help="input File (in Weighted CNF format)")
-    parser.add_argument("outputFile", help="output File (in Weighted CNF format)")
+    parser.add_argument(
+        "--error-bound", help="Give every weight the fewest bits that keep the relative error of the weighted count below this. --prec is then only used for comparison",
+        type=float, dest="error_bound")
+    parser.add_argument(
+        "--encoding", help="How the weights are encoded: 'chain' formulas (the default), or 'compact' comparators whose size is linear in the precision, with auxiliary variables that are not in the show set",
+        choices=ENCODINGS, default="chain")
+    parser.add_argument(
+        "--batch", help="Convert all CNFs in a directory, glob or manifest file. Can be given multiple times",
+        action="append", metavar="SRC")
+    parser.add_argument("--outdir", help="Output directory of --batch")
+    parser.add_argument(
+        "--plan", help="Print the exact size of the output of all CNFs in a directory, glob or manifest file, i.e. added vars, clauses, literals, bytes and div, without converting them. Can be given multiple times",
+        action="append", metavar="SRC")
+    parser.add_argument("--jobs", help="Number of worker processes for --batch and --plan. Default: number of CPUs",
+                        type=int, default=os.cpu_count())
+    parser.add_argument("--summary", help="Summary table of --batch (default: OUTDIR/summary.tsv) or --plan (default: - for stdout)")
+    parser.add_argument("--serve", help="Run as a server that converts the jobs sent to this Unix socket on --jobs warm workers, see weighted_to_unweighted_client.py",
+                        metavar="SOCKET")
+    parser.add_argument("--queue", help="Jobs --serve takes at a time before it stops accepting connections. Default: 2*--jobs",
+                        type=int)
+    parser.add_argument("--parse-jobs", help="Scan a large uncompressed input in chunks on this many worker processes. Default: 1",
+                        type=int, default=1, dest="parse_jobs")
+    parser.add_argument("--parse-cache", help="Keep the parsed input CNFs in this directory, in a binary form that is loaded much faster than the CNF is parsed. The cache of a CNF is found by its SHA-256 and checked against it",
+                        metavar="DIR", dest="parse_cache")
+    parser.add_argument("--result-cache", help="Keep the outputs in this directory, keyed by the SHA-256 of the input CNF, the options and the converter version. Converting the same CNF with the same options again copies the kept output",
+                        metavar="DIR", dest="result_cache")
+    parser.add_argument("--result-cache-size", help="Size in MB that --result-cache is kept at by removing the least recently used outputs. Default: %d" % RESULT_CACHE_SIZE,
+                        type=int, default=RESULT_CACHE_SIZE, metavar="MB", dest="result_cache_size")
+    parser.add_argument("--result-cache-link", help="Hard link outputs from and to --result-cache instead of copying them. They then share their file with the cache entry, and must not be changed in place",
+                        action="store_const", const=True, dest="result_cache_link")
+    parser.add_argument("--result-cache-stats", help="Print the hits, misses and evictions of --result-cache over all runs, and its size, then exit",
+                        action="store_const", const=True, dest="result_cache_stats")
+    parser.add_argument("--stats", help="Write phase times, counters and peak memory as JSON to this file, or to stderr if it is -")
+    parser.add_argument("--show-ranges", help="Also write the sampling set of the output to this file, one run of consecutive variables 'FIRST LAST' per line",
+                        dest="show_ranges")
+    parser.add_argument("--count", help="Stream the converted CNF into the stdin of this model counter, e.g. 'approxmc', instead of writing it to outputFile, and print the weighted count. {} in it is replaced by /dev/stdin",
+                        metavar="CMD")
+    parser.add_argument("--split", help="Write K CNFs, with K a power of 2, whose projected counts add up to that of the output, to be counted in parallel: OUT.0.cnf ... OUT.K-1.cnf and OUT.manifest.json, which says how to combine their counts",
+                        type=int, metavar="K")
+    parser.add_argument("--indexed", help="Write the output so that --delta can change its weights in place: every chain in a padded block of its own, listed in OUT.index. Only with the chain encoding and --prec, to an uncompressed file",
+                        action="store_const", const=True)
+    parser.add_argument("--delta", help="Change the weights of an --indexed output, given as the only file, to those of the 'c p weight' lines of this file. Only their chains, the header and the multiplier line are rewritten",
+                        metavar="CHANGES")
+    parser.add_argument("--profile", help="Profile the conversion with cProfile and write the pstats to this file")
+    parser.add_argument(
+        "--trace-memory", help="Trace Python allocations with tracemalloc and add the peak and the top allocations to --stats. Slows the conversion down",
+        action="store_const", const=True, dest="trace_memory")
+    parser.add_argument("inputFile", help="input File (in Weighted CNF format)", nargs="?")
+    parser.add_argument("outputFile", help="output File (in Weighted CNF format)", nargs="?")
     args = parser.parse_args()
 
     if args.prec is None:
         print("ERROR: you must give the --prec option, e.g. --prec 7")
         exit(-1)
 
+    if args.error_bound is not None and args.error_bound <= 0:
+        print("ERROR: --error-bound must be positive")
+        exit(-1)
+
+    if args.parse_jobs < 1:
+        print("ERROR: --parse-jobs must be at least 1")
+        exit(-1)
+
+    if args.result_cache_size < 0:
+        print("ERROR: --result-cache-size must not be negative")
+        exit(-1)
+
+    if args.result_cache_stats:
+        if args.result_cache is None:
+            print("ERROR: --result-cache-stats needs --result-cache DIR")
+            exit(-1)
+        stats = read_cache_stats(args.result_cache)
+        entries = [n for n in (os.listdir(args.result_cache) if os.path.isdir(args.result_cache) else [])
+                   if n.endswith(".out")]
+        size = sum(os.path.getsize(os.path.join(args.result_cache, n)) for n in entries)
+        print("Result cache hits: %d misses: %d evictions: %d" % (stats["hits"], stats["misses"], stats["evictions"]))
+        print("Result cache entries: %d size: %0.1f MB of %d MB" % (len(entries), size/(1024*1024), args.result_cache_size))
+        exit(0)
+
     decimal.getcontext().prec = 100
 
-    startTime = time.time()
-    c = Converter(precision=args.prec, verbose=args.verbose)
+    if args.serve is not None:
+        if args.batch is not None or args.inputFile is not None:
+            print("ERROR: --serve takes its jobs from the socket, not from --batch or the command line")
+            exit(-1)
+        if args.jobs < 1 or (args.queue is not None and args.queue < 1):
+            print("ERROR: --jobs and --queue must be at least 1")
+            exit(-1)
+        exit(serve(args.serve, args.jobs, args.queue if args.queue is not None else 2*args.jobs))
+
+    if args.plan is not None:
+        if args.batch is not None or args.inputFile is not None:
+            print("ERROR: --plan takes its inputs from its own sources, not from --batch or the command line")
+            exit(-1)
+        if args.jobs < 1:
+            print("ERROR: --jobs must be at least 1")
+            exit(-1)
+        options = {"precision": args.prec, "error_bound": args.error_bound, "encoding": args.encoding,
+                   "parse_cache": args.parse_cache}
+        exit(run_plan(args.plan, options, args.jobs, args.summary if args.summary is not None else '-'))
+
+    if args.batch is not None:
+        if args.outdir is None:
+            print("ERROR: --batch needs an output directory, e.g. --outdir converted")
+            exit(-1)
+        if args.summary is None:
+            args.summary = os.path.join(args.outdir, "summary.tsv")
+        if (args.profile is not None or args.trace_memory or args.parse_jobs > 1 or args.show_ranges is not None
+                or args.count is not None or args.split is not None or args.indexed or args.delta is not None):
+            print("ERROR: --profile, --trace-memory, --parse-jobs, --show-ranges, --count, --split, --indexed and --delta only work on a single file, not with --batch")
+            exit(-1)
+        options = {"precision": args.prec, "error_bound": args.error_bound, "encoding": args.encoding,
+                   "parse_cache": args.parse_cache, "result_cache": args.result_cache,
+                   "result_cache_size": args.result_cache_size, "result_cache_link": args.result_cache_link}
+        exit(run_batch(args.batch, args.outdir, options, args.jobs, args.summary, args.stats))
+
+    if args.delta is not None:
+        if args.inputFile is None or args.outputFile is not None:
+            print("ERROR: with --delta you must give the --indexed output to change, and no other file")
+            exit(-1)
+        startTime = time.time()
+        c = Converter(precision=args.prec, verbose=args.verbose)
+        with open(args.delta, 'r') as f:
+            res = c.apply_delta(args.inputFile, f)
+        print("Changed the chains of %d vars, %d of them moved to a new block, and %d weights of vars in no clause" % (
+            res["changed"], res["relocated"], res["folded"]))
+        print("Clauses: %d  multiplier: %s" % (res["clauses"], res["multiplier"]))
+        print("Time to change: %0.3f s" % (time.time()-startTime))
+        exit(0)
+
+    if args.count is not None:
+        if args.inputFile is None or args.outputFile is not None:
+            print("ERROR: with --count you must give an input file, but no output file")
+            exit(-1)
+    elif args.inputFile is None or args.outputFile is None:
+        print("ERROR: you must give an input and an output file")
+        exit(-1)
+
+    if args.result_cache is not None and (args.count is not None or args.show_ranges is not None):
+        print("ERROR: --count and --show-ranges need the conversion itself, they do not work with --result-cache")
+        exit(-1)
+
+    if args.indexed:
+        if args.encoding != "chain" or args.error_bound is not None:
+            print("ERROR: --indexed needs the chain encoding and a uniform --prec, not --encoding compact or --error-bound")
+            exit(-1)
+        if args.count is not None or args.split is not None or args.result_cache is not None:
+            print("ERROR: --indexed does not work with --count, --split or --result-cache")
+            exit(-1)
+        if any(args.outputFile.endswith(ext) for ext in CODECS):
+            print("ERROR: --indexed outputs are changed in place, they cannot be compressed")
+            exit(-1)
+        if sqlite3 is None:
+            print("ERROR: --indexed and --delta need Python's sqlite3 module")
+            exit(-1)
 
-    # read in input CNF
-    with open(args.inputFile, 'r') as f:
-        lines = f.readlines()
+    if args.split is not None:
+        if args.split < 2 or args.split & (args.split-1) != 0:
+            print("ERROR: --split must be a power of 2, at least 2")
+            exit(-1)
+        if args.count is not None or args.result_cache is not None:
+            print("ERROR: --split does not work with --count or --result-cache")
+            exit(-1)
 
-    ret = c.transform(lines, args.outputFile)
+    if args.trace_memory:
+        tracemalloc.start()
+    prof = None
+    if args.profile is not None:
+        prof = cProfile.Profile()
+        prof.enable()
 
+    startTime = time.time()
+    c = Converter(precision=args.prec, verbose=args.verbose, error_bound=args.error_bound,
+                  parse_jobs=args.parse_jobs, encoding=args.encoding, parse_cache=args.parse_cache,
+                  result_cache=args.result_cache, result_cache_size=args.result_cache_size,
+                  result_cache_link=bool(args.result_cache_link), indexed=bool(args.indexed))
+
+    # the input CNF is streamed, never read into memory as a whole
+    if args.count is not None:
+        with open_cnf(args.inputFile, 'rb') as f:
+            ret = c.count(f, args.count)
+    elif args.split is not None:
+        ret = c.split_file(args.inputFile, args.outputFile, args.split)
+    else:
+        ret = c.transform_file(args.inputFile, args.outputFile)
+    totalTime = time.time()-startTime
+
+    if prof is not None:
+        prof.disable()
+        prof.dump_stats(args.profile)
+
+    if args.show_ranges is not None:
+        with open(args.show_ranges, 'w') as f:
+            f.write(''.join("%d %d\n" % run for run in c.sampl_set.to_ranges()))
+
+    # from the stats, which a result cache hit has kept
+    stats = c.get_stats(ret)
+    counters = stats["counters"]
     print("Orig vars: %-7d Added vars: %-7d" % (ret.origVars, ret.vars-ret.origVars))
     print("The resulting count you have to divide by: 2**%d" % ret.div)
-    print("Time to transform: %0.3f s" % (time.time()-startTime))
+    print("Chain formula cache hits: %d misses: %d" % (stats["cacheHits"], stats["cacheMisses"]))
+    if counters.get("foldedVars", 0) > 0:
+        print("Weighted vars in no clause, folded into the multiplier: %d" % counters["foldedVars"])
+    if c.encoding == "compact":
+        chain_lits = counters["chainFormulaLits"]
+        saved = chain_lits-counters["weightLits"]
+        print("Compact encoding: %d auxiliary vars, %d literals instead of %d with chain formulas, saved %d (%0.1f%%)" % (
+            counters["auxVars"], counters["weightLits"], chain_lits, saved, 100.0*saved/chain_lits if chain_lits else 0.0))
+    if c.error_bound is not None:
+        added = ret.vars-ret.origVars
+        print("Relative error of the weighted count is at most: %g (target: %g)" % (stats["achievedError"], c.error_bound))
+        print("Uniform --prec %d would add %d vars with error at most %g, saved %d vars" % (
+            c.precision, stats["uniformAddedVars"], stats["uniformError"], stats["uniformAddedVars"]-added))
+    if args.split is not None:
+        shards = c.manifest["shards"]
+        print("Split into %d shards on vars %s, each with %0.2f%% to %0.2f%% of the count" % (
+            len(shards), " ".join(map(str, c.manifest["splitVars"])),
+            100*min(sh["fraction"][0] for sh in shards), 100*max(sh["fraction"][1] for sh in shards)))
+        print("Manifest written to %s" % shard_name(args.outputFile, None))
+    if args.indexed:
+        print("Index written to %s" % index_name(args.outputFile))
+    if args.count is not None:
+        print("Count of the counter: %s" % exact_decimal(ret.count))
+        print("Multiplier: %s" % ret.multiplier)
+        print("Weighted count (approximately): %s" % format(
+            decimal.Decimal(ret.weighted.numerator)/decimal.Decimal(ret.weighted.denominator), '.10g'))
+        print("Weighted count: %s" % exact_decimal(ret.weighted))
+    print("Time to transform: %0.3f s" % totalTime)
+    if args.stats is not None:
+        stats["time"] = totalTime
+        if args.count is not None:
+            stats["count"] = exact_decimal(ret.count)
+            stats["weightedCount"] = exact_decimal(ret.weighted)
+        write_stats(stats, args.stats)
     exit(0)
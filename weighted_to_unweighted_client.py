@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2016-2020 Kuldeep S Meel, Mate Soos
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# The same command line as weighted_to_unweighted.py for a single file, but
+# the conversion is done by a server started with
+#   ./weighted_to_unweighted.py --serve SOCKET --jobs N
+# so that only this small script has to start up. It only imports what it
+# needs to talk to the server.
+
+import time
+import argparse
+import json
+import os
+import socket
+import sys
+
+
+def convert(sock_path, inputFile, outputFile, options):
+    req = {"input": os.path.abspath(inputFile), "output": os.path.abspath(outputFile), "options": options}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(sock_path)
+        except OSError as e:
+            print("ERROR: Could not connect to the server on %s: %s" % (sock_path, e))
+            exit(-1)
+        s.sendall((json.dumps(req) + "\n").encode())
+        with s.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        print("ERROR: The server on %s closed the connection without an answer" % sock_path)
+        exit(-1)
+    return json.loads(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", help="Unix socket of the server. Default: $W2U_SOCKET",
+                        default=os.environ.get("W2U_SOCKET"))
+    parser.add_argument(
+        "--verbose", help="Verbose debug printing", action="store_const",
+        const=True)
+    parser.add_argument("--prec", help="Precision (value of m)", type=int, default=7)
+    parser.add_argument(
+        "--error-bound", help="Give every weight the fewest bits that keep the relative error of the weighted count below this. --prec is then only used for comparison",
+        type=float, dest="error_bound")
+    parser.add_argument("--encoding", help="How the weights are encoded: 'chain' formulas (the default) or 'compact' comparators",
+                        choices=["chain", "compact"], default="chain")
+    parser.add_argument("--parse-cache", help="Directory of the server's binary parse caches", metavar="DIR",
+                        dest="parse_cache")
+    parser.add_argument("--result-cache", help="Directory where the server keeps the outputs, to copy them from when the same CNF is converted again with the same options",
+                        metavar="DIR", dest="result_cache")
+    parser.add_argument("--result-cache-size", help="Size in MB that --result-cache is kept at. Default: the server's",
+                        type=int, metavar="MB", dest="result_cache_size")
+    parser.add_argument("--result-cache-link", help="Hard link outputs from and to --result-cache instead of copying them",
+                        action="store_const", const=True, dest="result_cache_link")
+    parser.add_argument("--stats", help="Write phase times, counters and peak memory as JSON to this file, or to stderr if it is -")
+    parser.add_argument("inputFile", help="input File (in Weighted CNF format)")
+    parser.add_argument("outputFile", help="output File (in Weighted CNF format)")
+    args = parser.parse_args()
+
+    if args.socket is None:
+        print("ERROR: you must give the --socket of the server, or set W2U_SOCKET")
+        exit(-1)
+
+    if args.error_bound is not None and args.error_bound <= 0:
+        print("ERROR: --error-bound must be positive")
+        exit(-1)
+
+    startTime = time.time()
+    options = {"precision": args.prec, "error_bound": args.error_bound, "encoding": args.encoding,
+               "verbose": args.verbose}
+    if args.parse_cache is not None:
+        options["parse_cache"] = os.path.abspath(args.parse_cache)
+    if args.result_cache is not None:
+        options["result_cache"] = os.path.abspath(args.result_cache)
+        options["result_cache_link"] = args.result_cache_link
+        if args.result_cache_size is not None:
+            options["result_cache_size"] = args.result_cache_size
+    res = convert(args.socket, args.inputFile, args.outputFile, options)
+    totalTime = time.time()-startTime
+
+    sys.stdout.write(res.get("output", ""))
+    if res["status"] != "ok":
+        if not res.get("output"):
+            print("ERROR: %s" % res["error"])
+        exit(-1)
+
+    stats = res["stats"]
+    print("Orig vars: %-7d Added vars: %-7d" % (res["origVars"], res["addedVars"]))
+    print("The resulting count you have to divide by: 2**%d" % res["div"])
+    print("Chain formula cache hits: %d misses: %d" % (stats["cacheHits"], stats["cacheMisses"]))
+    if stats["counters"].get("foldedVars", 0) > 0:
+        print("Weighted vars in no clause, folded into the multiplier: %d" % stats["counters"]["foldedVars"])
+    if args.encoding == "compact":
+        chain_lits = stats["counters"]["chainFormulaLits"]
+        saved = chain_lits-stats["counters"]["weightLits"]
+        print("Compact encoding: %d auxiliary vars, %d literals instead of %d with chain formulas, saved %d (%0.1f%%)" % (
+            stats["counters"]["auxVars"], stats["counters"]["weightLits"], chain_lits, saved, 100.0*saved/chain_lits if chain_lits else 0.0))
+    if args.error_bound is not None:
+        print("Relative error of the weighted count is at most: %g (target: %g)" % (stats["achievedError"], args.error_bound))
+        print("Uniform --prec %d would add %d vars with error at most %g, saved %d vars" % (
+            args.prec, stats["uniformAddedVars"], stats["uniformError"], stats["uniformAddedVars"]-res["addedVars"]))
+    print("Time to transform: %0.3f s" % totalTime)
+    if args.stats is not None:
+        stats["time"] = totalTime
+        if args.stats == "-":
+            json.dump(stats, sys.stderr, indent=1)
+            sys.stderr.write("\n")
+        else:
+            with open(args.stats, 'w') as f:
+                json.dump(stats, f, indent=1)
+    exit(0)